@@ -7,7 +7,6 @@ Download Spotify songs to mp3 with full metadata and cover art!
 :License: MIT (see /LICENSE).
 """
 
-from .savify import *
 from .types import *
 
 __title__ = 'Savify'
@@ -20,6 +19,19 @@ __docformat__ = 'restructuredtext en'
 __all__ = ['savify', 'types', 'utils']
 
 
+def __getattr__(name):
+    # Savify pulls in the download machinery, so it is only imported once it is asked for.
+    if name == 'Savify':
+        from .savify import Savify
+        return Savify
+
+    if name == 'AsyncSavify':
+        from .aio import AsyncSavify
+        return AsyncSavify
+
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
 def cli():
     from .cli import main
     main()
@@ -9,4 +9,6 @@ if __package__ is None and not hasattr(sys, 'frozen'):
 import savify
 
 if __name__ == '__main__':
+    from multiprocessing import freeze_support
+    freeze_support()
     savify.cli()
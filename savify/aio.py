@@ -0,0 +1,93 @@
+"""Asyncio interface for Savify."""
+
+__all__ = ['AsyncSavify']
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from .savify import LinkTracker, Savify
+from .types import Type
+
+
+class AsyncSavify:
+    """Drives a Savify instance from an event loop, yielding each song's status as soon as it finishes.
+
+    Blocking work (Spotify requests, youtube-dl, cover art and FFmpeg) runs on a shared thread pool, and every
+    pipeline stage is bounded by an asyncio semaphore sized by the Savify worker counts, so any number of
+    concurrent downloads can share one instance.
+    """
+
+    def __init__(self, savify: Savify = None, **kwargs) -> None:
+        self.savify = savify or Savify(**kwargs)
+        self._stages = self.savify._build_pipeline().stages
+        self._executor = ThreadPoolExecutor(sum(stage.workers for stage in self._stages) + 1,
+                                            thread_name_prefix='savify-async')
+        self._slots = None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *_) -> None:
+        await self.close()
+
+    async def download(self, query, query_type=Type.TRACK, artist_albums: bool = False):
+        """Async iterator over the status of every song found by the query, in the order they finish.
+
+        Songs start downloading as soon as the first page of them is listed, from the same de-duplicated feed
+        of jobs as Savify.iter_download.
+        """
+        loop = asyncio.get_running_loop()
+        if self._slots is None:
+            self._slots = [asyncio.Semaphore(stage.workers) for stage in self._stages]
+
+        await self._run(self.savify._start)
+        jobs, links = list(), list()
+        feed = self.savify._iter_query_jobs([query], query_type, artist_albums, jobs, links=links)
+        tracker = LinkTracker(links)
+        listing = loop.create_task(self._run(partial(next, feed, None)))
+        tasks = set()
+
+        try:
+            while listing is not None or tasks:
+                done, _ = await asyncio.wait(tasks | {listing} - {None}, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task is listing:
+                        job = task.result()
+                        listing = None
+                        if job is not None:
+                            listing = loop.create_task(self._run(partial(next, feed, None)))
+                            tasks.add(loop.create_task(self._process(job)))
+                        continue
+
+                    tasks.remove(task)
+                    status = task.result()
+                    yield status
+                    for link in tracker.ready(status):
+                        yield await self._run(partial(self.savify._finish_link, link))
+
+            for link in tracker.ready():
+                yield await self._run(partial(self.savify._finish_link, link))
+        finally:
+            for task in tasks | {listing} - {None}:
+                task.cancel()
+
+            self.savify.queue_size -= len(jobs)
+            self.savify.completed -= len(jobs)
+
+    async def close(self) -> None:
+        await self._run(self.savify.transcoder.shutdown)
+        self._executor.shutdown(wait=False)
+
+    async def _process(self, job: dict) -> dict:
+        for stage, slots in zip(self._stages, self._slots):
+            if job['returncode'] != -1:
+                break
+
+            async with slots:
+                job = await self._run(partial(stage, job))
+
+        return job
+
+    async def _run(self, function):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, function)
@@ -0,0 +1,259 @@
+"""Persistent caches kept in the Savify data directory."""
+
+__all__ = ['ResolutionCache', 'MetadataCache', 'CoverArtCache']
+
+import json
+import os
+import time
+import zlib
+from hashlib import sha1
+from pathlib import Path
+from shutil import move
+from threading import Event, Lock
+
+from .utils import connect
+
+DAY = 24 * 60 * 60
+EVICT_EVERY = 100
+MB = 1024 * 1024
+
+RESOLUTION_TTL = 30 * DAY
+RESOLUTION_MAX_ENTRIES = 100000
+METADATA_TTL = 7 * DAY
+METADATA_MAX_SIZE = 256 * MB
+COVER_ART_MAX_SIZE = 512 * MB
+
+
+class ResolutionCache:
+    """Remembers which YouTube video each recording resolved to, so re-runs can skip the search."""
+
+    def __init__(self, location: Path, ttl: float = None, max_entries: int = None) -> None:
+        self.location = Path(location)
+        self.ttl = ttl or RESOLUTION_TTL
+        self.max_entries = max_entries or RESOLUTION_MAX_ENTRIES
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._lock = Lock()
+        self._connection = connect(self.location)
+
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS resolutions ('
+                                     'track_id TEXT PRIMARY KEY, '
+                                     'video_id TEXT NOT NULL, '
+                                     'created REAL NOT NULL, '
+                                     'last_used REAL NOT NULL)')
+
+    def get(self, track_id: str):
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute('SELECT video_id, created FROM resolutions WHERE track_id = ?',
+                                           (track_id,)).fetchone()
+
+            if row is None or now - row[1] > self.ttl:
+                if row is not None:
+                    self._connection.execute('DELETE FROM resolutions WHERE track_id = ?', (track_id,))
+
+                self.misses += 1
+                return None
+
+            self._connection.execute('UPDATE resolutions SET last_used = ? WHERE track_id = ?', (now, track_id))
+            self.hits += 1
+            return row[0]
+
+    def put(self, track_id: str, video_id: str) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO resolutions VALUES (?, ?, ?, ?)',
+                                     (track_id, video_id, now, now))
+
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 0:
+                self._evict()
+
+    def invalidate(self, track_id: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM resolutions WHERE track_id = ?', (track_id,))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self) -> None:
+        self._connection.execute('DELETE FROM resolutions WHERE created < ?', (time.time() - self.ttl,))
+        count = self._connection.execute('SELECT COUNT(*) FROM resolutions').fetchone()[0]
+        if count > self.max_entries:
+            self._connection.execute('DELETE FROM resolutions WHERE track_id IN ('
+                                     'SELECT track_id FROM resolutions ORDER BY last_used LIMIT ?)',
+                                     (count - self.max_entries,))
+
+
+class MetadataCache:
+    """Stores Spotify API responses on disk, so unchanged objects don't have to be fetched again.
+
+    Entries expire after the TTL, unless they were stored with a version (e.g. a playlist's snapshot_id)
+    that the caller can revalidate cheaply. The least recently used entries are evicted once the cache
+    grows past max_size bytes.
+    """
+
+    def __init__(self, location: Path, ttl: float = None, max_size: int = None) -> None:
+        self.location = Path(location)
+        self.ttl = ttl or METADATA_TTL
+        self.max_size = max_size or METADATA_MAX_SIZE
+        self._puts = 0
+        self._lock = Lock()
+        self._connection = connect(self.location)
+
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS metadata ('
+                                     'key TEXT PRIMARY KEY, '
+                                     'version TEXT, '
+                                     'data BLOB NOT NULL, '
+                                     'size INTEGER NOT NULL, '
+                                     'created REAL NOT NULL, '
+                                     'last_used REAL NOT NULL)')
+
+    def get(self, key: str, version: str = None):
+        """Returns the cached data, or None if it is missing, expired or stored for another version."""
+        now = time.time()
+        with self._lock, self._connection:
+            row = self._connection.execute('SELECT version, data, created FROM metadata WHERE key = ?',
+                                           (key,)).fetchone()
+            if row is None:
+                return None
+
+            cached_version, data, created = row
+            if version is not None:
+                fresh = cached_version == version
+            else:
+                fresh = now - created <= self.ttl
+
+            if not fresh:
+                self._connection.execute('DELETE FROM metadata WHERE key = ?', (key,))
+                return None
+
+            self._connection.execute('UPDATE metadata SET last_used = ? WHERE key = ?', (now, key))
+
+        return json.loads(zlib.decompress(data))
+
+    def put(self, key: str, data, version: str = None) -> None:
+        blob = zlib.compress(json.dumps(data, separators=(',', ':')).encode('utf8'))
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?, ?)',
+                                     (key, version, blob, len(blob), now, now))
+
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 0:
+                self._evict()
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self) -> None:
+        self._connection.execute('DELETE FROM metadata WHERE version IS NULL AND created < ?',
+                                 (time.time() - self.ttl,))
+        total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM metadata').fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        evicted = list()
+        for key, size in self._connection.execute('SELECT key, size FROM metadata ORDER BY last_used'):
+            evicted.append((key,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+        self._connection.executemany('DELETE FROM metadata WHERE key = ?', evicted)
+
+
+class CoverArtCache:
+    """Keeps cover art on disk, named by a hash of its URL, so each image is only downloaded once across runs.
+
+    Concurrent requests for the same image share a single download. The least recently used images are
+    deleted once the directory grows past max_size bytes.
+    """
+
+    def __init__(self, location: Path, directory: Path, max_size: int = None) -> None:
+        self.location = Path(location)
+        self.directory = Path(directory)
+        self.max_size = max_size or COVER_ART_MAX_SIZE
+        self._puts = 0
+        self._downloads = dict()
+        self._lock = Lock()
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self._connection = connect(self.location)
+
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS cover_art ('
+                                     'key TEXT PRIMARY KEY, '
+                                     'size INTEGER NOT NULL, '
+                                     'last_used REAL NOT NULL)')
+
+    def get(self, url: str, download) -> Path:
+        """Returns the cached image for url, calling download(url) -> Path to fetch it on a miss."""
+        key = sha1(url.encode('utf8')).hexdigest()
+        path = self.directory / f'{key}.jpg'
+
+        with self._lock:
+            if path.is_file():
+                with self._connection:
+                    self._connection.execute('UPDATE cover_art SET last_used = ? WHERE key = ?', (time.time(), key))
+                return path
+
+            waiting = key in self._downloads
+            if not waiting:
+                self._downloads[key] = (Event(), list())
+
+            done, errors = self._downloads[key]
+
+        if waiting:
+            done.wait()
+            if errors:
+                raise errors[0]
+            return path
+
+        try:
+            move(str(download(url)), str(path))
+            size = path.stat().st_size
+        except Exception as ex:
+            errors.append(ex)
+            raise
+        finally:
+            with self._lock:
+                del self._downloads[key]
+            done.set()
+
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO cover_art VALUES (?, ?, ?)', (key, size, time.time()))
+
+            self._puts += 1
+            if self._puts % EVICT_EVERY == 0:
+                self._evict()
+
+        return path
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+    def _evict(self) -> None:
+        total = self._connection.execute('SELECT COALESCE(SUM(size), 0) FROM cover_art').fetchone()[0]
+        if total <= self.max_size:
+            return
+
+        evicted = list()
+        for key, size in self._connection.execute('SELECT key, size FROM cover_art ORDER BY last_used'):
+            evicted.append((key,))
+            total -= size
+            if total <= self.max_size:
+                break
+
+        for key, in evicted:
+            try:
+                os.remove(self.directory / f'{key}.jpg')
+            except OSError:
+                pass
+
+        self._connection.executemany('DELETE FROM cover_art WHERE key = ?', evicted)
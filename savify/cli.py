@@ -3,13 +3,11 @@ import sys
 import re
 import click
 import logging
-from os import system
 from pathlib import Path
 
 from . import __version__, __author__
 from .types import *
 from .utils import PathHolder, create_dir
-from .savify import Savify
 from .logger import Logger
 from .exceptions import FFmpegNotInstalledError, SpotifyApiCredentialsNotSetError, UrlNotSupportedError, \
     InternetConnectionError
@@ -30,8 +28,6 @@ BANNER = rf"""
 
 """
 
-system('title Savify')
-
 
 class Choices:
     BOOL = ['true', 'false']
@@ -39,6 +35,9 @@ class Choices:
     TYPE = ['track', 'album', 'playlist', 'artist']
     QUALITY = ['best', '320k', '256k', '192k', '128k', '96k', '32k', 'worst']
     FORMAT = ['mp3', 'aac', 'flac', 'm4a', 'opus', 'vorbis', 'wav']
+    ENGINE = ['thread', 'process']
+    UPSTREAM = ['spotify', 'search', 'media', 'cover-art']
+    LINK_MODE = ['copy', 'hardlink', 'symlink']
     GROUPING = "%artist%, %album%, %playlist% separated by /"
 
 
@@ -50,11 +49,25 @@ def get_choice() -> str:
     return input('[INPUT]\tEnter choice: ').lower()
 
 
+def set_title() -> None:
+    if sys.platform == 'win32':
+        import ctypes
+        ctypes.windll.kernel32.SetConsoleTitleW('Savify')
+
+
 def show_banner() -> None:
     click.clear()
     click.echo(BANNER)
 
 
+def days(value):
+    return value and value * 24 * 60 * 60
+
+
+def megabytes(value):
+    return value and value * 1024 * 1024
+
+
 def validate_group(_ctx, _param, value):
     regex = r"^((%artist%|%album%|%playlist%)(\/(%artist%|%album%|%playlist%))*)+$"
     if re.search(regex, str(value)) or value is None:
@@ -63,6 +76,24 @@ def validate_group(_ctx, _param, value):
         raise click.BadParameter('Group must be in the form x or x/x/x... where x in [%artist%, %album%, %playlist%]')
 
 
+def validate_rate_limits(_ctx, _param, value):
+    rate_limits = dict()
+    for rate_limit in value:
+        upstream, _, rate = rate_limit.partition('=')
+        try:
+            upstream, rate = convert_upstream(upstream), float(rate)
+        except (KeyError, ValueError):
+            rate = -1
+
+        if rate < 0:
+            raise click.BadParameter(f'Rate limits must be in the form x=n where x in [{choices(Choices.UPSTREAM)}] '
+                                     f'and n is requests per second, 0 for no limit')
+
+        rate_limits[upstream] = rate or None
+
+    return rate_limits
+
+
 def guided_cli(type, quality, format, output, group, path, m3u, artist_albums, skip_cover_art):
     choice = ''
     options = ['0', '1', '2', '3', '4', '5', '6', '7', '8', '9']
@@ -169,11 +200,57 @@ def guided_cli(type, quality, format, output, group, path, m3u, artist_albums, s
 @click.option('-a', '--artist-albums', is_flag=True, help='Download all artist songs and albums'
                                                           ', not just top 10 songs.')
 @click.option('--skip-cover-art', is_flag=True, help='Don\'t add cover art to downloaded song(s).')
+@click.option('--link-mode', default=Choices.LINK_MODE[0], type=click.Choice(Choices.LINK_MODE),
+              help='How a song already downloaded to another directory is reused. Hardlinks and symlinks save '
+                   'disk space, symlinks break if the first download is deleted.')
+@click.option('--skip-update-check', is_flag=True, help='Don\'t check GitHub for a newer release of Savify.')
+@click.option('-i', '--input', 'input_file', default=None, type=click.File('r'),
+              help='Read queries from a file, one per line, or from stdin with -. Songs found by more than one '
+                   'query are only downloaded once.')
+@click.option('--sync', is_flag=True, help='Only download the songs added to a playlist since it was last synced.')
+@click.option('--prune', is_flag=True, help='When syncing, delete songs removed from the playlist.')
+@click.option('--resolve-workers', default=None, help='Number of concurrent YouTube searches. [default: CPU count]',
+              type=click.IntRange(min=1))
+@click.option('--fetch-workers', default=None, help='Number of concurrent media downloads. [default: CPU count]',
+              type=click.IntRange(min=1))
+@click.option('--transcode-workers', default=None, help='Number of concurrent FFmpeg conversions. '
+                                                        '[default: CPU count]', type=click.IntRange(min=1))
+@click.option('--transcode-engine', default=Choices.ENGINE[0], help='Run FFmpeg jobs from threads or from a pool '
+                                                                    'of worker processes.',
+              type=click.Choice(Choices.ENGINE))
+@click.option('--single-pass/--two-pass', default=True, help='Convert, tag and add cover art with a single FFmpeg '
+                                                             'run written straight to the output directory.')
+@click.option('--transcode-niceness', default=0, help='Niceness added to the FFmpeg processes, with either engine.',
+              type=click.IntRange(min=0, max=19))
+@click.option('--rate-limit', 'rate_limits', multiple=True, callback=validate_rate_limits,
+              help=f'Requests per second allowed to an upstream, as x=n where x in [{choices(Choices.UPSTREAM)}]. '
+                   f'0 means no limit. Can be given more than once.')
+@click.option('--http-pool-size', default=None, help='Connections kept open to each host for cover art and Spotify. '
+                                                     '[default: 16]', type=click.IntRange(min=1))
+@click.option('--http-timeout', default=None, help='Seconds to wait for a response from Spotify or the cover art '
+                                                   'host. [default: 30]', type=click.FloatRange(min=1))
+@click.option('--resolution-cache-ttl', default=None, help='Days a YouTube search result is reused for. '
+                                                           '[default: 30]', type=click.IntRange(min=1))
+@click.option('--resolution-cache-entries', default=None, help='Number of YouTube search results kept. '
+                                                               '[default: 100000]', type=click.IntRange(min=1))
+@click.option('--metadata-cache-ttl', default=None, help='Days a Spotify response is reused for. [default: 7]',
+              type=click.IntRange(min=1))
+@click.option('--metadata-cache-size', default=None, help='Megabytes of Spotify responses kept. [default: 256]',
+              type=click.IntRange(min=1))
+@click.option('--cover-art-cache-size', default=None, help='Megabytes of cover art kept. [default: 512]',
+              type=click.IntRange(min=1))
 @click.option('--silent', is_flag=True, help='Hide all output to stdout, overrides verbosity level.')
 @click.option('-v', '--verbose', count=True, help='Change the log verbosity level. [-v, -vv]')
 @click.argument('query', required=False)
 @click.pass_context
-def main(ctx, type, quality, format, output, group, path, m3u, artist_albums, verbose, silent, query, skip_cover_art):
+def main(ctx, type, quality, format, output, group, path, m3u, artist_albums, verbose, silent, query, skip_cover_art,
+         resolve_workers, fetch_workers, transcode_workers, transcode_engine, transcode_niceness, single_pass,
+         sync, prune, rate_limits, http_pool_size, http_timeout, skip_update_check, input_file,
+         link_mode, resolution_cache_ttl, resolution_cache_entries, metadata_cache_ttl, metadata_cache_size,
+         cover_art_cache_size):
+    from .savify import Savify
+
+    set_title()
     if not silent:
         show_banner()
         log_level = convert_log_level(verbose)
@@ -181,10 +258,15 @@ def main(ctx, type, quality, format, output, group, path, m3u, artist_albums, ve
         log_level = None
 
     guided = False
-    if not query:
+    queries = [query] if query else list()
+    if input_file is not None:
+        queries += read_queries(input_file)
+
+    elif not query:
         guided = True
         type, quality, format, output, group, path, m3u, query, artist_albums, skip_cover_art = \
             guided_cli(type, quality, format, output, group, path, m3u, artist_albums, skip_cover_art)
+        queries = [query]
 
     path_holder = PathHolder(path, output)
     output_format = convert_format(format)
@@ -193,52 +275,67 @@ def main(ctx, type, quality, format, output, group, path, m3u, artist_albums, ve
     logger = Logger(path_holder.data_path, log_level)
     ydl_options = {ctx.args[i][2:]: ctx.args[i+1] for i in range(0, len(ctx.args), 2)}
 
-    def setup(ffmpeg='ffmpeg'):
-        return Savify(quality=quality, download_format=output_format, path_holder=path_holder, group=group,
-                      skip_cover_art=skip_cover_art, logger=logger, ffmpeg_location=ffmpeg, ydl_options=ydl_options)
+    s = Savify(quality=quality, download_format=output_format, path_holder=path_holder, group=group,
+               skip_cover_art=skip_cover_art, logger=logger, ydl_options=ydl_options,
+               resolve_workers=resolve_workers, fetch_workers=fetch_workers,
+               transcode_workers=transcode_workers, transcode_engine=convert_engine(transcode_engine),
+               transcode_niceness=transcode_niceness, single_pass=single_pass, rate_limits=rate_limits,
+               http_pool_size=http_pool_size, http_timeout=http_timeout, check_updates=not skip_update_check,
+               link_mode=convert_link_mode(link_mode), resolution_cache_ttl=days(resolution_cache_ttl),
+               resolution_cache_entries=resolution_cache_entries, metadata_cache_ttl=days(metadata_cache_ttl),
+               metadata_cache_size=megabytes(metadata_cache_size), cover_art_cache_size=megabytes(cover_art_cache_size))
 
     def check_guided():
         if guided:
             input('\n[INFO]\tPress enter to exit...')
 
+    def run():
+        if sync:
+            for playlist in queries:
+                s.sync(playlist, create_m3u=m3u, prune=prune)
+        elif input_file is not None:
+            s.download_many(queries, query_type=query_type, create_m3u=m3u, artist_albums=artist_albums)
+        else:
+            s.download(query, query_type=query_type, create_m3u=m3u, artist_albums=artist_albums)
+
     try:
-        s = setup()
-    except FFmpegNotInstalledError as ex:
-        from .ffmpegdl import FFmpegDL
-        ffmpeg_dl = FFmpegDL(str(path_holder.data_path))
-
-        if not ffmpeg_dl.check_if_file():
-            logger.error(ex.message)
-            if silent:
-                check_guided()
-                return 1
-
-            choice = input('[INPUT]\tWould you like Savify to download FFmpeg for you? (Y/n) ')
-            if choice.lower() == 'y' or not choice:
-                logger.info('Downloading FFmpeg...')
-                try:
-                    ffmpeg_location = ffmpeg_dl.download()
-                except:
-                    logger.error('Failed to download FFmpeg!')
+        try:
+            run()
+        except FFmpegNotInstalledError as ex:
+            from .ffmpegdl import FFmpegDL
+            ffmpeg_dl = FFmpegDL(str(path_holder.data_path))
+
+            if not ffmpeg_dl.check_if_file():
+                logger.error(ex.message)
+                if silent:
                     check_guided()
                     return 1
 
-                logger.info(f'FFmpeg downloaded! [{ffmpeg_location}]')
+                choice = input('[INPUT]\tWould you like Savify to download FFmpeg for you? (Y/n) ')
+                if choice.lower() == 'y' or not choice:
+                    logger.info('Downloading FFmpeg...')
+                    try:
+                        ffmpeg_location = ffmpeg_dl.download()
+                    except:
+                        logger.error('Failed to download FFmpeg!')
+                        check_guided()
+                        return 1
+
+                    logger.info(f'FFmpeg downloaded! [{ffmpeg_location}]')
+                else:
+                    check_guided()
+                    return 1
             else:
-                check_guided()
-                return 1
-        else:
-            ffmpeg_location = ffmpeg_dl.final_location
+                ffmpeg_location = ffmpeg_dl.final_location
+
+            s.ffmpeg_location = str(ffmpeg_location)
+            run()
 
-        s = setup(ffmpeg=str(ffmpeg_location))
     except SpotifyApiCredentialsNotSetError as ex:
         logger.error(ex.message)
         check_guided()
         return 1
 
-    try:
-        s.download(query, query_type=query_type, create_m3u=m3u, artist_albums=artist_albums)
-
     except UrlNotSupportedError as ex:
         logger.error(ex.message)
         check_guided()
@@ -253,6 +350,17 @@ def main(ctx, type, quality, format, output, group, path, m3u, artist_albums, ve
     return 0
 
 
+def read_queries(file) -> list:
+    """Returns the queries in a batch file, skipping blank lines and # comments."""
+    queries = list()
+    for line in file:
+        line = line.strip()
+        if line and not line.startswith('#'):
+            queries.append(line)
+
+    return queries
+
+
 def convert_type(query_type: str) -> Type:
     mapping = {
         'track': Type.TRACK,
@@ -293,6 +401,36 @@ def convert_format(output_format: str) -> Format:
     return mapping[output_format.lower()]
 
 
+def convert_engine(engine: str) -> str:
+    mapping = {
+        'thread': Engine.THREAD,
+        'process': Engine.PROCESS,
+    }
+
+    return mapping[engine.lower()]
+
+
+def convert_upstream(upstream: str) -> str:
+    mapping = {
+        'spotify': Upstream.SPOTIFY,
+        'search': Upstream.SEARCH,
+        'media': Upstream.MEDIA,
+        'cover-art': Upstream.COVER_ART,
+    }
+
+    return mapping[upstream.lower()]
+
+
+def convert_link_mode(link_mode: str) -> str:
+    mapping = {
+        'copy': LinkMode.COPY,
+        'hardlink': LinkMode.HARDLINK,
+        'symlink': LinkMode.SYMLINK,
+    }
+
+    return mapping[link_mode.lower()]
+
+
 def convert_bool(boolean) -> bool:
     return boolean.lower() == 'true'
 
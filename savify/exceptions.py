@@ -50,6 +50,15 @@ class YoutubeDlExtractionError(SavifyError):
         return self.message
 
 
+class FFmpegConversionError(SavifyError):
+    def __init__(self, message='FFmpeg failed to convert the song!'):
+        self.message = message
+        super().__init__(self.message)
+
+    def __str__(self):
+        return self.message
+
+
 class InternetConnectionError(SavifyError):
     def __init__(self, message='Connection timed out, check you have a stable internet connection!'):
         self.message = message
@@ -0,0 +1,224 @@
+"""Persistent index of the songs Savify has already downloaded."""
+
+__all__ = ['DownloadIndex', 'SyncState', 'JobJournal']
+
+import json
+import time
+from os import stat
+from os.path import abspath
+from pathlib import Path
+from threading import Lock
+
+from .types import JobState
+from .utils import connect
+
+# SQLite refuses statements with more than 999 bound variables on older builds.
+_MAX_VARIABLES = 900
+
+# Seconds a failed track's progress (and its temp media) is kept for a retry to resume from.
+FAILED_TTL = 7 * 24 * 60 * 60
+
+
+class DownloadIndex:
+    """Maps ISRCs (or Spotify ids) to the files they were downloaded to, so later runs can skip them in bulk."""
+
+    def __init__(self, location: Path) -> None:
+        self.location = Path(location)
+        self._lock = Lock()
+        self._connection = connect(self.location)
+
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS downloads ('
+                                     'track_id TEXT NOT NULL, '
+                                     'format TEXT NOT NULL, '
+                                     'quality TEXT NOT NULL, '
+                                     'location TEXT NOT NULL, '
+                                     'size INTEGER, '
+                                     'mtime REAL, '
+                                     'PRIMARY KEY (track_id, format, quality, location))')
+
+    def lookup(self, track_ids: list, download_format: str, quality: str) -> dict:
+        """Returns {track_id: [location, ...]} for every given id downloaded with this format and quality."""
+        found = dict()
+        track_ids = list(set(track_ids))
+
+        with self._lock:
+            for i in range(0, len(track_ids), _MAX_VARIABLES):
+                chunk = track_ids[i:i + _MAX_VARIABLES]
+                rows = self._connection.execute(
+                    f'SELECT track_id, location FROM downloads WHERE format = ? AND quality = ? '
+                    f'AND track_id IN ({", ".join("?" * len(chunk))})',
+                    [download_format, quality, *chunk])
+
+                for track_id, location in rows:
+                    found.setdefault(track_id, list()).append(location)
+
+        return found
+
+    def add(self, track_id: str, download_format: str, quality: str, location: Path) -> None:
+        try:
+            file_stat = stat(location)
+            size, mtime = file_stat.st_size, file_stat.st_mtime
+        except OSError:
+            size, mtime = None, None
+
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO downloads VALUES (?, ?, ?, ?, ?, ?)',
+                                     (track_id, download_format, quality, normalise_location(location),
+                                      size, mtime))
+
+    def remove(self, track_id: str, download_format: str, quality: str, location: Path) -> None:
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM downloads WHERE track_id = ? AND format = ? AND quality = ? '
+                                     'AND location = ?',
+                                     (track_id, download_format, quality, normalise_location(location)))
+
+    def remove_location(self, download_format: str, quality: str, location: Path) -> None:
+        """Forgets the file at location, whichever id it was recorded under."""
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM downloads WHERE format = ? AND quality = ? AND location = ?',
+                                     (download_format, quality, normalise_location(location)))
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class SyncState:
+    """Remembers the snapshot id and tracks of every playlist synced with a given format, quality and group."""
+
+    def __init__(self, location: Path) -> None:
+        self.location = Path(location)
+        self._lock = Lock()
+        self._connection = connect(self.location)
+
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS playlists ('
+                                     'playlist_id TEXT NOT NULL, '
+                                     'format TEXT NOT NULL, '
+                                     'quality TEXT NOT NULL, '
+                                     'grouping TEXT NOT NULL, '
+                                     'snapshot_id TEXT, '
+                                     'tracks TEXT NOT NULL, '
+                                     'PRIMARY KEY (playlist_id, format, quality, grouping))')
+
+    def get(self, playlist_id: str, download_format: str, quality: str, group: str) -> tuple:
+        """Returns (snapshot_id, [[track_id, location, title], ...]) from the last sync, or (None, [])."""
+        with self._lock:
+            row = self._connection.execute('SELECT snapshot_id, tracks FROM playlists WHERE playlist_id = ? '
+                                           'AND format = ? AND quality = ? AND grouping = ?',
+                                           (playlist_id, download_format, quality, group or '')).fetchone()
+
+        if row is None:
+            return None, list()
+
+        return row[0], json.loads(row[1])
+
+    def put(self, playlist_id: str, download_format: str, quality: str, group: str, snapshot_id: str,
+            tracks: list) -> None:
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR REPLACE INTO playlists VALUES (?, ?, ?, ?, ?, ?)',
+                                     (playlist_id, download_format, quality, group or '', snapshot_id,
+                                      json.dumps(tracks)))
+
+    def locations(self, exclude: tuple = None) -> set:
+        """Returns the location of every track of every synced playlist, except those of exclude.
+
+        exclude is a (playlist_id, format, quality, group) key as passed to get.
+        """
+        if exclude is not None:
+            playlist_id, download_format, quality, group = exclude
+            exclude = (playlist_id, download_format, quality, group or '')
+
+        locations = set()
+        with self._lock:
+            rows = self._connection.execute('SELECT playlist_id, format, quality, grouping, tracks FROM playlists')
+            for *key, tracks in rows.fetchall():
+                if tuple(key) != exclude:
+                    locations.update(entry[1] for entry in json.loads(tracks))
+
+        return locations
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+class JobJournal:
+    """Records how far each track got, so a run that was stopped can pick up where it left off.
+
+    A track moves from queued to resolved (with the video id found for it) to downloaded (with the media in
+    the temp directory) and then to done or failed.
+    """
+
+    def __init__(self, location: Path) -> None:
+        self.location = Path(location)
+        self._lock = Lock()
+        self._connection = connect(self.location)
+
+        with self._lock, self._connection:
+            self._connection.execute('CREATE TABLE IF NOT EXISTS jobs ('
+                                     'track_id TEXT NOT NULL, '
+                                     'format TEXT NOT NULL, '
+                                     'quality TEXT NOT NULL, '
+                                     'state TEXT NOT NULL, '
+                                     'video_id TEXT, '
+                                     'source TEXT, '
+                                     'acodec TEXT, '
+                                     'error TEXT, '
+                                     'updated REAL NOT NULL, '
+                                     'PRIMARY KEY (track_id, format, quality))')
+
+    def queue(self, track_ids: list, download_format: str, quality: str) -> None:
+        """Adds the tracks that aren't in the journal yet, keeping the progress of those that are."""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.executemany('INSERT OR IGNORE INTO jobs (track_id, format, quality, state, updated) '
+                                         'VALUES (?, ?, ?, ?, ?)',
+                                         [(track_id, download_format, quality, JobState.QUEUED, now)
+                                          for track_id in track_ids])
+
+    def get(self, track_id: str, download_format: str, quality: str):
+        """Returns the track's {state, video_id, source, acodec, error}, or None if it isn't in the journal."""
+        with self._lock:
+            row = self._connection.execute('SELECT state, video_id, source, acodec, error FROM jobs '
+                                           'WHERE track_id = ? AND format = ? AND quality = ?',
+                                           (track_id, download_format, quality)).fetchone()
+
+        if row is None:
+            return None
+
+        return dict(zip(('state', 'video_id', 'source', 'acodec', 'error'), row))
+
+    def update(self, track_id: str, download_format: str, quality: str, state: str, video_id: str = None,
+               source: str = None, acodec: str = None, error: str = None) -> None:
+        """Moves the track to state, keeping the video id, source and codec already recorded unless given."""
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute('INSERT OR IGNORE INTO jobs (track_id, format, quality, state, updated) '
+                                     'VALUES (?, ?, ?, ?, ?)', (track_id, download_format, quality, state, now))
+            self._connection.execute('UPDATE jobs SET state = ?, video_id = COALESCE(?, video_id), '
+                                     'source = COALESCE(?, source), acodec = COALESCE(?, acodec), error = ?, '
+                                     'updated = ? WHERE track_id = ? AND format = ? AND quality = ?',
+                                     (state, video_id, source, acodec, error, now, track_id, download_format,
+                                      quality))
+
+    def expire(self, failed_ttl: float = FAILED_TTL) -> None:
+        """Forgets done tracks, and failed ones that haven't been retried within failed_ttl seconds."""
+        with self._lock, self._connection:
+            self._connection.execute('DELETE FROM jobs WHERE state = ? OR (state = ? AND updated < ?)',
+                                     (JobState.DONE, JobState.FAILED, time.time() - failed_ttl))
+
+    def unfinished(self) -> set:
+        """Returns the ids of every track that isn't done, in any format or quality."""
+        with self._lock:
+            rows = self._connection.execute('SELECT DISTINCT track_id FROM jobs WHERE state != ?', (JobState.DONE,))
+            return {row[0] for row in rows}
+
+    def close(self) -> None:
+        with self._lock:
+            self._connection.close()
+
+
+def normalise_location(location) -> str:
+    return abspath(str(location))
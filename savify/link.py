@@ -0,0 +1,38 @@
+"""Classifies queries as Spotify links without touching the network."""
+
+__all__ = ['is_link', 'parse_link']
+
+import re
+from urllib.parse import urlsplit
+
+from .types import Type
+
+SPOTIFY_HOSTS = {'open.spotify.com', 'play.spotify.com'}
+LINK_TYPES = {Type.TRACK, Type.ALBUM, Type.PLAYLIST, Type.ARTIST, Type.EPISODE, Type.SHOW}
+_ID = re.compile(r'[0-9A-Za-z]{22}')
+
+
+def is_link(query: str) -> bool:
+    return query.strip().lower().startswith(('http://', 'https://', 'spotify:'))
+
+
+def parse_link(query: str):
+    """Returns (type, id) for a spotify: URI or an open.spotify.com link, or None if the query isn't one."""
+    query = query.strip()
+    if query.lower().startswith('spotify:'):
+        parts = query.split(':')[1:]
+    else:
+        url = urlsplit(query)
+        if url.scheme.lower() not in {'http', 'https'} or (url.hostname or '').lower() not in SPOTIFY_HOSTS:
+            return None
+
+        parts = [part for part in url.path.split('/') if part]
+
+    # The id follows its type, e.g. track/<id>, intl-de/album/<id> or user/<name>/playlist/<id>, so the
+    # parts are read from the end in case a user name looks like a type.
+    for position in range(len(parts) - 2, -1, -1):
+        link_type, link_id = parts[position].lower(), parts[position + 1]
+        if link_type in LINK_TYPES and _ID.fullmatch(link_id):
+            return link_type, link_id
+
+    return None
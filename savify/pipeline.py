@@ -0,0 +1,112 @@
+"""Staged worker pipeline used to download songs."""
+
+__all__ = ['Stage', 'Pipeline']
+
+from queue import Queue
+from threading import Event, Lock, Thread
+
+_DONE = object()
+
+
+class Stage:
+    """A step of the pipeline run by its own pool of worker threads.
+
+    If the function raises, on_error(job, error) is called to finish the job, by default only its returncode
+    and error are set. If on_error raises too, the job is failed with the default and the error is re-raised
+    by Pipeline.run once every job is through.
+    """
+
+    def __init__(self, name: str, function, workers: int, on_error=None) -> None:
+        self.name = name
+        self.function = function
+        self.workers = max(1, int(workers))
+        self.on_error = on_error or _fail
+
+    def __call__(self, job: dict) -> dict:
+        try:
+            return self.function(job)
+        except Exception as ex:
+            return self.on_error(job, f'{self.name.capitalize()} failed. [{ex}]')
+
+
+def _fail(job: dict, error: str) -> dict:
+    job['returncode'] = 1
+    job['error'] = error
+    return job
+
+
+class Pipeline:
+    """Passes jobs through a chain of stages connected by bounded queues.
+
+    A job is a status dict; once a stage sets its ``returncode`` to anything but -1 the job is finished
+    and skips the remaining stages.
+    """
+
+    def __init__(self, stages: list, buffer: int = 2) -> None:
+        self.stages = stages
+        self.buffer = buffer
+
+    def run(self, jobs):
+        """Feeds the given jobs through every stage, yielding each one as soon as it finishes."""
+        queues = [Queue(maxsize=stage.workers * self.buffer) for stage in self.stages]
+        queues.append(Queue())
+        cancelled = Event()
+        feed_error = list()
+        stage_error = list()
+        threads = list()
+
+        def feed() -> None:
+            try:
+                for job in jobs:
+                    if cancelled.is_set():
+                        break
+                    queues[0].put(job)
+            except Exception as ex:
+                feed_error.append(ex)
+            finally:
+                queues[0].put(_DONE)
+
+        threads.append(Thread(target=feed, name='savify-feed', daemon=True))
+
+        for position, stage in enumerate(self.stages):
+            remaining = [stage.workers]
+            lock = Lock()
+
+            def work(stage=stage, source=queues[position], sink=queues[position + 1], remaining=remaining,
+                     lock=lock) -> None:
+                while True:
+                    job = source.get()
+                    if job is _DONE:
+                        source.put(_DONE)
+                        with lock:
+                            remaining[0] -= 1
+                            if remaining[0] == 0:
+                                sink.put(_DONE)
+                        return
+
+                    if job['returncode'] == -1 and not cancelled.is_set():
+                        try:
+                            job = stage(job)
+                        except Exception as ex:
+                            stage_error.append(ex)
+                            _fail(job, f'{stage.name.capitalize()} failed. [{ex}]')
+
+                    sink.put(job)
+
+            for worker in range(stage.workers):
+                threads.append(Thread(target=work, name=f'savify-{stage.name}-{worker}', daemon=True))
+
+        for thread in threads:
+            thread.start()
+
+        try:
+            while True:
+                job = queues[-1].get()
+                if job is _DONE:
+                    break
+                yield job
+        finally:
+            cancelled.set()
+
+        if feed_error or stage_error:
+            raise (feed_error or stage_error)[0]
@@ -0,0 +1,97 @@
+"""Rate limiting and backoff for the services Savify talks to."""
+
+__all__ = ['TokenBucket', 'RateLimiter', 'backoff', 'retry_after']
+
+import random
+import time
+from threading import Lock
+
+from .types import Upstream
+
+# Requests per second allowed to each upstream by default, None means unlimited.
+DEFAULT_RATE_LIMITS = {
+    Upstream.SPOTIFY: 10,
+    Upstream.SEARCH: 5,
+    Upstream.MEDIA: None,
+    Upstream.COVER_ART: None,
+}
+
+
+def backoff(attempt: int, retry_after_seconds: float = None, base: float = 1.0, cap: float = 60.0) -> float:
+    """Seconds to wait before retry number attempt, honouring the server's Retry-After if it sent one."""
+    if retry_after_seconds is not None:
+        return min(retry_after_seconds, cap)
+
+    # Full jitter, so threads that failed together don't all retry together.
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def retry_after(headers):
+    """Parses a Retry-After header given in seconds or as an HTTP date."""
+    value = headers.get('Retry-After') if headers is not None else None
+    if value is None:
+        return None
+
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+
+    from email.utils import parsedate_to_datetime
+
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class TokenBucket:
+    """Allows rate requests per second on average, with bursts of up to burst requests."""
+
+    def __init__(self, rate: float = None, burst: float = None) -> None:
+        self.rate = rate
+        self.capacity = burst or max(1.0, rate or 1.0)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = Lock()
+
+    def acquire(self) -> None:
+        """Blocks until a request may be made."""
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                wait = self._paused_until - now
+
+                if wait <= 0:
+                    if self.rate is None:
+                        return
+
+                    self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                    self._updated = now
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+
+                    wait = (1 - self._tokens) / self.rate
+
+            time.sleep(wait)
+
+    def pause(self, seconds: float) -> None:
+        """Holds back every request for the given time, e.g. after the upstream asked us to slow down."""
+        with self._lock:
+            self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+
+class RateLimiter:
+    """A token bucket per upstream, shared by every thread of a Savify instance."""
+
+    def __init__(self, rate_limits: dict = None) -> None:
+        rate_limits = {**DEFAULT_RATE_LIMITS, **(rate_limits or dict())}
+        self.buckets = {upstream: TokenBucket(rate) for upstream, rate in rate_limits.items()}
+
+    def acquire(self, upstream: str) -> None:
+        self.buckets[upstream].acquire()
+
+    def pause(self, upstream: str, seconds: float) -> None:
+        self.buckets[upstream].pause(seconds)
@@ -0,0 +1,72 @@
+"""Picks the YouTube video that best matches a track from a page of search results."""
+
+__all__ = ['score', 'best_candidate']
+
+import re
+
+from .track import Track
+
+SEARCH_RESULTS = 5
+
+# A candidate this many seconds longer or shorter than the track gets no credit for its duration.
+DURATION_TOLERANCE = 30
+
+# Versions that are rarely the one wanted, unless the track's own name says so.
+UNWANTED = {'live', 'remix', 'cover', 'extended', 'karaoke', 'instrumental', 'acoustic', 'nightcore', 'slowed',
+            'sped', 'reverb', '8d', 'bass', 'boosted', 'hour', 'loop', 'reaction', 'tutorial', 'lesson'}
+
+WEIGHTS = {
+    'duration': 0.45,
+    'title': 0.3,
+    'artist': 0.15,
+    'channel': 0.1,
+}
+
+UNWANTED_PENALTY = 0.25
+
+_WORD = re.compile(r'\w+')
+
+
+def _words(text) -> set:
+    return set(_WORD.findall(str(text or '').lower()))
+
+
+def score(track: Track, candidate: dict) -> float:
+    """Scores a search result from 0 (no match) up to 1 (a perfect match) for the track."""
+    title = _words(candidate.get('title'))
+    uploader = str(candidate.get('uploader') or '')
+    channel = _words(uploader)
+    name = _words(track.name)
+    artists = _words(' '.join(track.artists))
+
+    total = 0.0
+    if track.duration_ms and candidate.get('duration'):
+        difference = abs(track.duration_ms / 1000 - candidate['duration'])
+        total += WEIGHTS['duration'] * max(0.0, 1 - difference / DURATION_TOLERANCE)
+    else:
+        # Without durations to compare, neither helps nor hurts the candidate.
+        total += WEIGHTS['duration'] / 2
+
+    if name:
+        total += WEIGHTS['title'] * len(name & title) / len(name)
+
+    if artists:
+        total += WEIGHTS['artist'] * len(artists & (title | channel)) / len(artists)
+
+    # Auto-generated "Artist - Topic" channels carry the studio recording, as do official and VEVO ones.
+    if uploader.endswith(' - Topic') or 'vevo' in uploader.lower() or 'official' in channel:
+        total += WEIGHTS['channel']
+
+    total -= UNWANTED_PENALTY * len((title - name) & UNWANTED)
+    return total
+
+
+def best_candidate(track: Track, candidates: list):
+    """Returns the candidate with the highest score, the earliest one on a tie, or None if there are none."""
+    best, best_score = None, None
+    for candidate in candidates:
+        candidate_score = score(track, candidate)
+        if best_score is None or candidate_score > best_score:
+            best, best_score = candidate, candidate_score
+
+    return best
@@ -2,39 +2,48 @@
 
 __all__ = ['Savify']
 
+import json
 import time
+from functools import partial
 from multiprocessing import cpu_count
-from multiprocessing.dummy import Pool as ThreadPool
 from pathlib import Path
-from shutil import move, Error as ShutilError
+from shutil import Error as ShutilError
+from threading import RLock, Thread
 from urllib.error import URLError
 
-import validators
-import tldextract
-import requests
-from youtube_dl import YoutubeDL
-from ffmpy import FFmpeg, FFRuntimeError
-
-from .utils import PathHolder, safe_path_string, check_env, check_ffmpeg, check_file, create_dir, clean
+from .utils import PathHolder, safe_path_string, check_env, check_ffmpeg, check_file, create_dir, clean, link_file
 from .types import *
-from .spotify import Spotify
 from .track import Track
+from .link import is_link, parse_link
+from .resolver import SEARCH_RESULTS, best_candidate
+from .index import DownloadIndex, SyncState, JobJournal, normalise_location
+from .cache import ResolutionCache, MetadataCache, CoverArtCache, DAY
+from .pipeline import Pipeline, Stage
+from .transcode import Transcoder, audio_options, transcode
+from .ratelimit import RateLimiter, backoff
 from .logger import Logger
 from .exceptions import FFmpegNotInstalledError, SpotifyApiCredentialsNotSetError, UrlNotSupportedError, \
-    YoutubeDlExtractionError, InternetConnectionError
+    YoutubeDlExtractionError, InternetConnectionError, FFmpegConversionError
+
+RELEASES_URL = 'https://api.github.com/repos/LaurenceRawlings/savify/releases/latest'
 
 
 def _sort_dir(track: Track, group: str) -> str:
     if not group:
         return str()
 
-    group = group.replace('%artist%', safe_path_string(track.artists[0]))
-    group = group.replace('%album%', safe_path_string(track.album_name))
-    group = group.replace('%playlist%', safe_path_string(track.playlist))
+    group = group.replace('%artist%', safe_path_string(track.artists[0], filesystem=True))
+    group = group.replace('%album%', safe_path_string(track.album_name, filesystem=True))
+    group = group.replace('%playlist%', safe_path_string(track.playlist, filesystem=True))
 
     return str(group)
 
 
+def _m3u_entry(position: int, title: str, location, m3u_location: Path) -> str:
+    from os.path import relpath
+    return f'#EXTINF:{str(position)},{title}\n{relpath(location, m3u_location.parent)}\n'
+
+
 def _progress(data) -> None:
     if data['status'] == 'downloading':
         pass
@@ -44,45 +53,124 @@ def _progress(data) -> None:
         raise YoutubeDlExtractionError
 
 
+def _first_entry(info):
+    if info and 'entries' in info:
+        entries = [entry for entry in info['entries'] if entry]
+        return entries[0] if entries else None
+
+    return info
+
+
+class LinkTracker:
+    """Hands back the links collected by Savify._iter_query_jobs once the job each one points to is finished."""
+
+    def __init__(self, links: list) -> None:
+        self.links = links
+        self._seen = 0
+        self._waiting = list()
+        self._finished = set()
+
+    def ready(self, status: dict = None) -> list:
+        """Marks status as finished and returns the links that can now be finished, or every link left."""
+        new = self.links[self._seen:]
+        self._seen += len(new)
+        self._waiting += new
+        if status is not None:
+            self._finished.add(id(status))
+
+        ready = [job for job in self._waiting if status is None or id(job['original']) in self._finished]
+        ready_ids = {id(job) for job in ready}
+        self._waiting = [job for job in self._waiting if id(job) not in ready_ids]
+        return ready
+
+
 class Savify:
     def __init__(self, api_credentials=None, quality=Quality.BEST, download_format=Format.MP3,
                  group=None, path_holder: PathHolder = None, retry: int = 3,
                  ydl_options: dict = None, skip_cover_art: bool = False, logger: Logger = None,
-                 ffmpeg_location: str = 'ffmpeg') -> None:
+                 ffmpeg_location: str = 'ffmpeg', use_index: bool = True, use_cache: bool = True,
+                 resolve_workers: int = None, fetch_workers: int = None, transcode_workers: int = None,
+                 transcode_engine: str = Engine.THREAD, transcode_niceness: int = 0,
+                 single_pass: bool = True, rate_limits: dict = None, http_pool_size: int = None,
+                 http_timeout=None, check_updates: bool = False, link_mode: str = LinkMode.COPY,
+                 use_journal: bool = True, resolution_cache_ttl: float = None,
+                 resolution_cache_entries: int = None, metadata_cache_ttl: float = None,
+                 metadata_cache_size: int = None, cover_art_cache_size: int = None) -> None:
 
         self.download_format = download_format
         self.ffmpeg_location = ffmpeg_location
+        self.api_credentials = api_credentials
         self.skip_cover_art = skip_cover_art
-        self.downloaded_cover_art = dict()
+        self.single_pass = single_pass
+        self.link_mode = link_mode
         self.quality = quality
         self.queue_size = 0
         self.completed = 0
         self.retry = retry
         self.group = group
+        self.resolve_workers = resolve_workers or cpu_count()
+        self.fetch_workers = fetch_workers or cpu_count()
+        self.transcode_workers = transcode_workers or cpu_count()
+        self.transcoder = Transcoder(self.transcode_workers, engine=transcode_engine, niceness=transcode_niceness)
+        self.rate_limiter = RateLimiter(rate_limits)
+        self.http_pool_size = http_pool_size
+        self.http_timeout = http_timeout
 
         # Config or defaults...
         self.ydl_options = ydl_options or dict()
         self.path_holder = path_holder or PathHolder()
         self.logger = logger or Logger(self.path_holder.data_path)
-
-        if api_credentials is None:
-            if not check_env():
-                raise SpotifyApiCredentialsNotSetError
-
-            self.spotify = Spotify()
-        else:
-            self.spotify = Spotify(api_credentials=api_credentials)
-
-        if not check_ffmpeg() and self.ffmpeg_location == 'ffmpeg':
-            raise FFmpegNotInstalledError
-
-        clean(self.path_holder.get_temp_dir())
-        self.check_for_updates()
-
-    def check_for_updates(self) -> None:
+        self.index = DownloadIndex(self.path_holder.data_path / 'index.db') if use_index else None
+        self.sync_state = SyncState(self.path_holder.data_path / 'index.db')
+        self.journal = JobJournal(self.path_holder.data_path / 'index.db') if use_journal else None
+        self.resolution_cache = ResolutionCache(self.path_holder.data_path / 'cache.db', ttl=resolution_cache_ttl,
+                                                max_entries=resolution_cache_entries) if use_cache else None
+        self.metadata_cache = MetadataCache(self.path_holder.data_path / 'cache.db', ttl=metadata_cache_ttl,
+                                            max_size=metadata_cache_size) if use_cache else None
+        self.cover_art_cache = CoverArtCache(self.path_holder.data_path / 'cache.db',
+                                             self.path_holder.data_path / 'cover_art',
+                                             max_size=cover_art_cache_size) if use_cache else None
+        self._session = None
+        self._spotify = None
+        self._ready = False
+        self._startup_lock = RLock()
+
+        # Past the SQLite stores and cover art directory opened above and the optional update check below,
+        # the network, FFmpeg and the temporary files are left alone until the first download.
+        if check_updates:
+            Thread(target=self.check_for_updates, name='savify-update-check', daemon=True).start()
+
+    @property
+    def session(self):
+        """The HTTP session shared by Spotify, cover art and the update check, created on first use."""
+        with self._startup_lock:
+            if self._session is None:
+                from .session import create_session
+                self._session = create_session(self.rate_limiter, pool_size=self.http_pool_size,
+                                               timeout=self.http_timeout, retries=self.retry)
+
+        return self._session
+
+    @property
+    def spotify(self):
+        """The Spotify client, created on first use."""
+        with self._startup_lock:
+            if self._spotify is None:
+                if self.api_credentials is None and not check_env():
+                    raise SpotifyApiCredentialsNotSetError
+
+                from .spotify import Spotify
+                self._spotify = Spotify(api_credentials=self.api_credentials, cache=self.metadata_cache,
+                                        requests_session=self.session, requests_timeout=self.session.timeout)
+
+        return self._spotify
+
+    def check_for_updates(self, timeout: float = 5) -> None:
         self.logger.info('Checking for updates...')
-        latest_ver = requests.get('https://api.github.com/repos/LaurenceRawlings/savify/releases/latest').json()[
-            'tag_name']
+        latest_ver = self._latest_version(timeout)
+        if latest_ver is None:
+            self.logger.info('Couldn\'t check for updates.')
+            return
 
         from . import __version__
         current_ver = f'v{__version__}'
@@ -93,85 +181,165 @@ class Savify:
             self.logger.info('A new version of Savify is available, '
                              'get the latest release here: https://github.com/LaurenceRawlings/savify/releases')
 
-    def _parse_query(self, query, query_type=Type.TRACK, artist_albums: bool = False) -> list:
-        result = list()
-        if validators.url(query) or query[:8] == 'spotify:':
-            if tldextract.extract(query).domain == Platform.SPOTIFY:
-                result = self.spotify.link(query, artist_albums=artist_albums)
-            else:
-                raise UrlNotSupportedError(query)
+    def _latest_version(self, timeout: float):
+        """Returns the tag of the latest release, asking GitHub at most once a day."""
+        cache = self.path_holder.data_path / 'latest_release.json'
+        try:
+            with open(cache) as cache_file:
+                cached = json.load(cache_file)
 
-        else:
-            if query_type == Type.TRACK:
-                result = self.spotify.search(query, query_type=Type.TRACK)
+            if time.time() - cached['checked'] < DAY:
+                return cached['tag_name']
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+
+        import requests
+
+        try:
+            latest_ver = self.session.get(RELEASES_URL, timeout=timeout).json()['tag_name']
+        except (requests.exceptions.RequestException, ValueError, KeyError, TypeError):
+            return None
+
+        try:
+            with open(cache, 'w') as cache_file:
+                json.dump({'tag_name': latest_ver, 'checked': time.time()}, cache_file)
+        except OSError:
+            pass
+
+        return latest_ver
+
+    def _start(self) -> None:
+        """Checks for FFmpeg and clears out the temp directory, once, before the first download."""
+        with self._startup_lock:
+            if self._ready:
+                return
+
+            if not check_ffmpeg() and self.ffmpeg_location == 'ffmpeg':
+                raise FFmpegNotInstalledError
+
+            self._clean_temp()
+            self._ready = True
 
-            elif query_type == Type.ALBUM:
-                result = self.spotify.search(query, query_type=Type.ALBUM)
+    def _iter_query(self, query, query_type=Type.TRACK, artist_albums: bool = False):
+        """Yields the tracks found by the query a page at a time, as they are fetched from Spotify."""
+        import requests
 
-            elif query_type == Type.PLAYLIST:
-                result = self.spotify.search(query, query_type=Type.PLAYLIST)
+        if is_link(query):
+            link = parse_link(query)
+            if link is None:
+                raise UrlNotSupportedError(query)
 
-            elif query_type == Type.ARTIST:
-                result = self.spotify.search(query, query_type=Type.ARTIST, artist_albums=artist_albums)
+            pages = self.spotify.iter_link(link, artist_albums=artist_albums)
 
-        return result
+        elif query_type in {Type.TRACK, Type.ALBUM, Type.PLAYLIST, Type.ARTIST}:
+            pages = self.spotify.iter_search(query, query_type=query_type, artist_albums=artist_albums)
+
+        else:
+            return
 
-    def download(self, query, query_type=Type.TRACK, create_m3u=False, artist_albums: bool = False) -> None:
         try:
-            queue = self._parse_query(query, query_type=query_type, artist_albums=artist_albums)
-            self.queue_size += len(queue)
-        except requests.exceptions.ConnectionError or URLError:
+            yield from pages
+        except (requests.exceptions.ConnectionError, URLError):
             raise InternetConnectionError
 
-        if not (len(queue) > 0):
-            self.logger.info('Nothing found using the given query.')
-            return
+    def _iter_query_jobs(self, queries, query_type, artist_albums: bool, jobs: list, results: list = None,
+                         skip_unsupported: bool = False, links: list = None):
+        """Yields a job per track found by the queries, checking the index a page at a time.
+
+        Every job is also appended to jobs, in query order. A recording found more than once only gets one
+        job, which is shared by the lists of each query's jobs appended to results. Where a track would be
+        saved somewhere else, it gets a link to the job instead, which goes in its query's list and in links,
+        see _iter_with_links.
+        """
+        known = dict()
+        for query in queries:
+            query_jobs = list()
+            if results is not None:
+                results.append(query_jobs)
 
-        self.logger.info(f'Downloading {len(queue)} songs...')
+            try:
+                for page in self._iter_query(query, query_type=query_type, artist_albums=artist_albums):
+                    tracks = dict()
+                    for track in page:
+                        if track.recording_id not in known:
+                            tracks.setdefault(track.recording_id, track)
+
+                    page_jobs = self._create_jobs(list(tracks.values()))
+                    known.update((job['track'].recording_id, job) for job in page_jobs)
+
+                    for track in page:
+                        job = known[track.recording_id]
+                        if job['track'] is not track and job['location'] != self._output_path(track):
+                            job = {'track': track, 'returncode': -1, 'location': self._output_path(track),
+                                   'original': job}
+                            if links is not None:
+                                links.append(job)
+                        query_jobs.append(job)
+
+                    self.queue_size += len(page_jobs)
+                    jobs.extend(page_jobs)
+                    self.logger.debug(f'Queued {len(page_jobs)} songs...')
+                    yield from page_jobs
+
+            except UrlNotSupportedError as ex:
+                if not skip_unsupported:
+                    raise
+
+                self.logger.error(ex.message)
+
+    def iter_download(self, query, query_type=Type.TRACK, artist_albums: bool = False):
+        """Downloads the songs found by the query, yielding each song's status as soon as it is done.
+
+        A status is a dict holding the ``track``, its ``returncode`` (0 on success), the output ``location``
+        and, if the song failed, the ``error``. Downloading starts as soon as the first page of songs is
+        listed.
+        """
+        jobs, links = list(), list()
+        feed = self._iter_query_jobs([query], query_type, artist_albums, jobs, links=links)
+        yield from self._iter_with_links(self._iter_jobs(feed, jobs), links)
+
+    def download(self, query, query_type=Type.TRACK, create_m3u=False, artist_albums: bool = False) -> list:
+        return self._download([query], query_type, create_m3u, artist_albums, skip_unsupported=False)
+
+    def download_many(self, queries, query_type=Type.TRACK, create_m3u=False, artist_albums: bool = False) -> list:
+        """Downloads the songs found by every query through one shared pipeline, each song only once.
+
+        Queries that aren't supported are logged and skipped. With create_m3u, an M3U file is written for
+        every query. Returns the status of every song, in query order.
+        """
+        return self._download(queries, query_type, create_m3u, artist_albums, skip_unsupported=True)
+
+    def _download(self, queries, query_type, create_m3u: bool, artist_albums: bool, skip_unsupported: bool) -> list:
+        self.logger.info('Downloading songs...')
         start_time = time.time()
-        with ThreadPool(cpu_count()) as pool:
-            jobs = pool.map(self._download, queue)
+        cache_hits, cache_misses = self._cache_counters()
+        jobs, links, results = list(), list(), list()
 
-        failed_jobs = list()
-        successful_jobs = list()
-        for job in jobs:
-            if job['returncode'] != 0:
-                failed_jobs.append(job)
-            else:
-                successful_jobs.append(job)
-
-        if create_m3u and len(successful_jobs) > 0:
-            track = successful_jobs[0]['track']
-            playlist = safe_path_string(track.playlist)
-
-            if not playlist:
-                if query_type in {Type.EPISODE, Type.SHOW, Type.ALBUM}:
-                    playlist = track.album_name
-                elif query_type is Type.ARTIST:
-                    playlist = track.artists[0]
-                else:
-                    playlist = track.name
-
-            m3u = f'#EXTM3U\n#PLAYLIST:{playlist}\n'
-            m3u_location = self.path_holder.get_download_dir() / f'{playlist}.m3u'
-
-            for job in successful_jobs:
-                track = job['track']
-                location = job['location']
-                m3u += f'#EXTINF:{str(queue.index(track))},{str(track)}\n'
-                from os.path import relpath
-                m3u += f'{relpath(location, m3u_location.parent)}\n'
-
-            self.logger.info('Creating the M3U playlist file..')
-            with open(m3u_location, 'w') as m3u_file:
-                m3u_file.write(m3u)
+        feed = self._iter_query_jobs(queries, query_type, artist_albums, jobs, results, skip_unsupported, links)
+        for _ in self._iter_with_links(self._iter_jobs(feed, jobs), links):
+            pass
+
+        jobs += links
+        if not (len(jobs) > 0):
+            self.logger.info('Nothing found using the given query.')
+            return jobs
+
+        failed_jobs = [job for job in jobs if job['returncode'] != 0]
+
+        if create_m3u:
+            for query_jobs in results:
+                self._write_m3u(query_jobs, query_type)
 
         self.logger.info('Cleaning up...')
-        clean(self.path_holder.get_temp_dir())
+        self._clean_temp()
 
-        message = f'Download Finished!\n\tCompleted {len(queue) - len(failed_jobs)}/{len(queue)}' \
+        message = f'Download Finished!\n\tCompleted {len(jobs) - len(failed_jobs)}/{len(jobs)}' \
                   f' songs in {time.time() - start_time:.0f}s\n'
 
+        if self.resolution_cache is not None:
+            hits, misses = self._cache_counters()
+            message += f'\tSearch cache: {hits - cache_hits} hits, {misses - cache_misses} misses\n'
+
         if len(failed_jobs) > 0:
             message += '\n\tFailed Tracks:\n'
             for failed_job in failed_jobs:
@@ -179,38 +347,332 @@ class Savify:
                            f'\n\tReason:\t{failed_job["error"]}\n'
 
         self.logger.info(message)
-        self.queue_size -= len(queue)
-        self.completed -= len(queue)
+        return jobs
+
+    def _iter_with_links(self, statuses, links: list):
+        """Yields the statuses coming out of the pipeline, each followed by the links to it that are now ready.
+
+        links is filled by _iter_query_jobs while the pipeline runs. Once every status is through, the links
+        still waiting are finished too.
+        """
+        tracker = LinkTracker(links)
+        for status in statuses:
+            yield status
+            for job in tracker.ready(status):
+                yield self._finish_link(job)
+
+        for job in tracker.ready():
+            yield self._finish_link(job)
+
+    def _finish_link(self, job: dict) -> dict:
+        """Materialises a song another query already downloaded into this query's directory."""
+        original = job.pop('original')
+        track = job['track']
+        output = job['location']
+
+        if original['returncode'] != 0:
+            job['returncode'] = 1
+            job['error'] = original.get('error')
+            return job
+
+        if not check_file(output):
+            try:
+                create_dir(output.parent)
+                link_file(original['location'], output, self.link_mode)
+            except OSError:
+                job['returncode'] = 1
+                job['error'] = 'Filesystem error.'
+                return job
+
+            self.logger.info(f'{str(track)} -> reused from {original["location"]}.')
+
+        self._record_download(track, output)
+        job['returncode'] = 0
+        return job
+
+    def _write_m3u(self, jobs: list, query_type) -> None:
+        successful_jobs = [job for job in jobs if job['returncode'] == 0]
+        if not successful_jobs:
+            return
 
-    def _download(self, track: Track) -> dict:
-        extractor = 'ytsearch'
-        if track.platform == Platform.SPOTIFY:
-            query = track.url if track.track_type == Type.EPISODE else f'{extractor}:{str(track)} audio'
+        track = successful_jobs[0]['track']
+        playlist = track.playlist
+
+        if not playlist:
+            if query_type in {Type.EPISODE, Type.SHOW, Type.ALBUM}:
+                playlist = track.album_name
+            elif query_type is Type.ARTIST:
+                playlist = track.artists[0]
+            else:
+                playlist = track.name
+
+        playlist = safe_path_string(playlist, filesystem=True)
+        m3u = f'#EXTM3U\n#PLAYLIST:{playlist}\n'
+        m3u_location = self.path_holder.get_download_dir() / f'{playlist}.m3u'
+
+        for position, job in enumerate(jobs):
+            if job['returncode'] != 0:
+                continue
+
+            m3u += _m3u_entry(position, str(job['track']), job['location'], m3u_location)
+
+        self.logger.info('Creating the M3U playlist file..')
+        with open(m3u_location, 'w') as m3u_file:
+            m3u_file.write(m3u)
+
+    def sync(self, query, create_m3u: bool = True, prune: bool = False) -> list:
+        """Brings a playlist up to date with its last sync, downloading only the tracks added since then.
+
+        If the playlist's snapshot id hasn't changed nothing is listed or downloaded. With prune, songs
+        removed from the playlist are deleted. Returns the statuses of the songs that were downloaded.
+        """
+        import requests
+
+        link = parse_link(query) if is_link(query) else None
+        if is_link(query) and (link is None or link[0] != Type.PLAYLIST):
+            raise UrlNotSupportedError(query, message='Only Spotify playlists can be synced!')
+
+        try:
+            if link is None:
+                playlist = self.spotify.get_playlist_snapshot(query, search=True)
+            else:
+                playlist = self.spotify.get_playlist_snapshot(link[1])
+        except (requests.exceptions.ConnectionError, URLError):
+            raise InternetConnectionError
+
+        if playlist is None:
+            self.logger.info('Nothing found using the given query.')
+            return list()
+
+        name = f"{playlist['name']} - {playlist['owner']['display_name']}"
+        state = (playlist['id'], self.download_format, self.quality, self.group)
+        snapshot_id, previous = self.sync_state.get(*state)
+
+        if snapshot_id == playlist['snapshot_id']:
+            self.logger.info(f'{name} -> is already up to date.')
+            return list()
+
+        try:
+            tracks = self.spotify.playlist_tracks(playlist['id'])
+        except (requests.exceptions.ConnectionError, URLError):
+            raise InternetConnectionError
+
+        synced = {entry[0]: entry for entry in previous}
+        current = {track.id for track in tracks}
+        added = [track for track in tracks if track.id not in synced]
+        removed = [entry for entry in previous if entry[0] not in current]
+
+        self.logger.info(f'Syncing {name}: {len(added)} added, {len(removed)} removed...')
+        start_time = time.time()
+        # Tracks of the same recording share one download.
+        recordings = dict()
+        for track in added:
+            recordings.setdefault(track.recording_id, track)
+
+        jobs = self._create_jobs(list(recordings.values()))
+        self.queue_size += len(jobs)
+
+        for _ in self._iter_jobs(iter(jobs), jobs):
+            pass
+
+        downloaded = {job['track'].recording_id: job for job in jobs if job['returncode'] == 0}
+        entries = list()
+        for track in tracks:
+            if track.id in synced:
+                entries.append(synced[track.id])
+            elif track.recording_id in downloaded:
+                location = downloaded[track.recording_id]['location']
+                entries.append([track.id, normalise_location(location), str(track)])
+
+        if prune and removed:
+            # Songs still listed by another synced playlist are kept, they may share the download directory.
+            self._prune(removed, {entry[1] for entry in entries} | self.sync_state.locations(exclude=state))
+
+        # Failed songs leave the snapshot unset, so the next sync retries them.
+        failed_jobs = [job for job in jobs if job['returncode'] != 0]
+        self.sync_state.put(*state, None if failed_jobs else playlist['snapshot_id'], entries)
+
+        if create_m3u:
+            self._write_sync_m3u(safe_path_string(name, filesystem=True), previous, entries, append=not removed)
+
+        self._clean_temp()
+        self.logger.info(f'Sync Finished!\n\tDownloaded {len(jobs) - len(failed_jobs)}/{len(jobs)} new songs'
+                         f'{", removed " + str(len(removed)) if prune else ""} in {time.time() - start_time:.0f}s\n')
+
+        return jobs
+
+    def _prune(self, removed: list, keep: set) -> None:
+        from os import remove
+
+        for _, location, title in removed:
+            if location in keep:
+                continue
+
+            try:
+                remove(location)
+                self.logger.info(f'{title} -> removed from the playlist. Deleted.')
+            except OSError:
+                pass
+
+            if self.index is not None:
+                self.index.remove_location(self.download_format, self.quality, location)
+
+    def _write_sync_m3u(self, playlist: str, previous: list, entries: list, append: bool) -> None:
+        m3u_location = self.path_holder.get_download_dir() / f'{playlist}.m3u'
+
+        # Songs only added to the end of the playlist are appended, otherwise the file is rewritten.
+        if append and check_file(m3u_location) and entries[:len(previous)] == previous:
+            mode, start, m3u = 'a', len(previous), ''
         else:
-            query = ''
+            mode, start, m3u = 'w', 0, f'#EXTM3U\n#PLAYLIST:{playlist}\n'
+
+        for position, (track_id, location, title) in enumerate(entries[start:], start=start):
+            m3u += _m3u_entry(position, title, location, m3u_location)
+
+        self.logger.info('Updating the M3U playlist file..')
+        with open(m3u_location, mode) as m3u_file:
+            m3u_file.write(m3u)
+
+    def _create_jobs(self, queue: list) -> list:
+        jobs = [status or self._new_job(track) for track, status in zip(queue, self._check_index(queue))]
+        if self.journal is not None:
+            self.journal.queue([job['track'].recording_id for job in jobs if job['returncode'] == -1],
+                               self.download_format, self.quality)
+
+        return jobs
+
+    def _clean_temp(self) -> None:
+        """Empties the temp directory, keeping the media of tracks the journal hasn't finished or given up on."""
+        keep = None
+        if self.journal is not None:
+            self.journal.expire()
+            keep = self.journal.unfinished()
+
+        clean(self.path_holder.get_temp_dir(), keep=keep)
 
-        output = self.path_holder.get_download_dir() / f'{_sort_dir(track, self.group)}' / safe_path_string(
-            f'{str(track)}.{self.download_format}')
+    def _update_journal(self, track: Track, state: str, **fields) -> None:
+        if self.journal is not None:
+            self.journal.update(track.recording_id, self.download_format, self.quality, state, **fields)
 
-        output_temp = f'{str(self.path_holder.get_temp_dir())}/{track.id}.%(ext)s'
+    def _iter_jobs(self, feed, jobs: list):
+        """Runs the jobs from feed through the pipeline, jobs holds every job fed so far."""
+        try:
+            self._start()
+            yield from self._build_pipeline().run(feed)
+        finally:
+            self.transcoder.shutdown()
+            self.queue_size -= len(jobs)
+            self.completed -= len(jobs)
+
+    def _cache_counters(self) -> tuple:
+        if self.resolution_cache is None:
+            return 0, 0
+
+        return self.resolution_cache.hits, self.resolution_cache.misses
+
+    def _output_path(self, track: Track) -> Path:
+        return self.path_holder.get_download_dir() / f'{_sort_dir(track, self.group)}' / safe_path_string(
+            f'{str(track)}.{self.download_format}', filesystem=True)
+
+    def _check_index(self, queue: list) -> list:
+        """Returns a status for every track the index already knows about, and None for those still to download."""
+        if self.index is None:
+            return [None] * len(queue)
+
+        # Downloads recorded before ISRCs were tracked are still found by their Spotify ids.
+        known = self.index.lookup([key for track in queue for key in {track.recording_id, track.id}],
+                                  self.download_format, self.quality)
+        statuses = list()
+
+        for track in queue:
+            locations = known.get(track.recording_id) or known.get(track.id)
+            if not locations:
+                statuses.append(None)
+                continue
+
+            output = self._output_path(track)
+            status = {
+                'track': track,
+                'returncode': 0,
+                'location': output,
+            }
+
+            location = normalise_location(output)
+            if location in locations and not check_file(output):
+                # The song was deleted since, so the row is stale and it is downloaded again.
+                self.index.remove_location(self.download_format, self.quality, output)
+                locations = [other for other in locations if other != location]
+
+            if location in locations:
+                self.logger.info(f'{str(track)} -> is already downloaded. Skipping...')
+            elif self._reuse_download(track, locations, output):
+                self.logger.info(f'{str(track)} -> reused from a previous download.')
+            else:
+                status = None
+
+            if status is not None:
+                self.completed += 1
+
+            statuses.append(status)
+
+        return statuses
+
+    def _reuse_download(self, track: Track, locations: list, output: Path) -> bool:
+        for location in locations:
+            if not check_file(Path(location)):
+                self.index.remove_location(self.download_format, self.quality, location)
+                continue
+
+            try:
+                create_dir(output.parent)
+                link_file(location, output, self.link_mode)
+            except OSError:
+                continue
+
+            self.index.add(track.recording_id, self.download_format, self.quality, output)
+            return True
 
-        status = {
+        return False
+
+    def _record_download(self, track: Track, output: Path) -> None:
+        if self.index is not None:
+            self.index.add(track.recording_id, self.download_format, self.quality, output)
+
+    def _new_job(self, track: Track) -> dict:
+        return {
             'track': track,
             'returncode': -1,
-            'location': output,
+            'location': self._output_path(track),
         }
 
-        if check_file(output):
-            self.logger.info(f'{str(track)} -> is already downloaded. Skipping...')
-            status['returncode'] = 0
-            self.completed += 1
-            return status
+    def _finish_job(self, job: dict, returncode: int, error: str = None) -> dict:
+        job['returncode'] = returncode
+        if error is not None:
+            job['error'] = error
+            self.logger.error(f'{str(job["track"])} -> {error}')
 
-        create_dir(output.parent)
+        for key in ('info', 'source', 'temp'):
+            job.pop(key, None)
 
-        options = {
+        self._update_journal(job['track'], JobState.DONE if returncode == 0 else JobState.FAILED, error=error)
+        self.completed += 1
+        return job
+
+    def _fail_job(self, job: dict, error: str) -> dict:
+        """Finishes a job whose stage raised, so it is logged, journaled and counted like any other failure."""
+        return self._finish_job(job, 1, error)
+
+    def _build_pipeline(self) -> Pipeline:
+        return Pipeline([
+            Stage('resolve', self._resolve, self.resolve_workers, on_error=self._fail_job),
+            Stage('fetch', self._fetch, self.fetch_workers, on_error=self._fail_job),
+            Stage('transcode', self._transcode, self.transcode_workers, on_error=self._fail_job),
+        ])
+
+    def _ydl_options(self, track: Track) -> dict:
+        return {
             'format': 'bestaudio/best',
-            'outtmpl': output_temp,
+            'outtmpl': f'{str(self.path_holder.get_temp_dir())}/{track.recording_id}.%(ext)s',
             'restrictfilenames': True,
             'ignoreerrors': True,
             'nooverwrites': True,
@@ -218,118 +680,183 @@ class Savify:
             'prefer_ffmpeg': True,
             'logger': self.logger,
             'progress_hooks': [_progress],
-
-            'postprocessors': [{
-                'key': 'FFmpegExtractAudio',
-                'preferredcodec': self.download_format,
-                'preferredquality': self.quality,
-            }],
-
-            'postprocessor_args': [
-                '-write_id3v1', '1',
-                '-id3v2_version', '3',
-                '-metadata', f'title={track.name}',
-                '-metadata', f'album={track.album_name}',
-                '-metadata', f'date={track.release_date}',
-                '-metadata', f'artist={"/".join(track.artists)}',
-                '-metadata', f'disc={track.disc_number}',
-                '-metadata', f'track={track.track_number}/{track.album_track_count}',
-            ],
-
             **self.ydl_options,
         }
 
-        output_temp = output_temp.replace('%(ext)s', self.download_format)
+    def _resolve(self, job: dict) -> dict:
+        """Finds the video to download for a track, without downloading any media."""
+        from youtube_dl import YoutubeDL
 
-        if self.download_format == Format.MP3:
-            options['postprocessor_args'].append('-codec:a')
-            options['postprocessor_args'].append('libmp3lame')
+        track = job['track']
+        output = job['location']
 
-        if self.ffmpeg_location != 'ffmpeg':
-            options['ffmpeg_location'] = self.ffmpeg_location
+        if check_file(output):
+            self.logger.info(f'{str(track)} -> is already downloaded. Skipping...')
+            self._record_download(track, output)
+            return self._finish_job(job, 0)
+
+        searchable = track.platform == Platform.SPOTIFY and track.track_type != Type.EPISODE
+        cacheable = searchable and self.resolution_cache is not None
+        if track.platform == Platform.SPOTIFY:
+            query = track.url if track.track_type == Type.EPISODE else f'ytsearch:{str(track)} audio'
+        else:
+            query = ''
 
+        entry = self.journal.get(track.recording_id, self.download_format, self.quality) if self.journal else None
+        if entry is not None and entry['source'] and check_file(Path(entry['source'])):
+            # Interrupted after the download, go straight to transcoding.
+            self.logger.debug(f'{str(track)} -> resuming from {entry["source"]}')
+            job['source'] = entry['source']
+            job['info'] = {'acodec': entry['acodec']}
+            return job
+
+        video_id = self.resolution_cache.get(track.recording_id) if cacheable else None
+        if video_id is None and entry is not None:
+            video_id = entry['video_id']
+        known = video_id is not None
+
+        options = self._ydl_options(track)
+        rejected = set()
         attempt = 0
         while True:
             attempt += 1
+            info = None
+
+            if video_id is None and searchable:
+                video_id = self._search(track, options, rejected)
 
+            self.rate_limiter.acquire(Upstream.SEARCH)
             try:
                 with YoutubeDL(options) as ydl:
-                    ydl.download([query])
-                    if check_file(Path(output_temp)):
-                        break
-
-            except YoutubeDlExtractionError as ex:
-                if attempt > self.retry:
-                    status['returncode'] = 1
-                    status['error'] = "Failed to download song."
-                    self.logger.error(ex.message)
-                    self.completed += 1
-                    return status
-
-        if self.download_format != Format.MP3 or self.skip_cover_art:
-            try:
-                move(output_temp, output)
-            except ShutilError:
-                status['returncode'] = 1
-                status['error'] = 'Filesystem error.'
-                self.logger.error('Failed to move temp file!')
-                self.completed += 1
-                return status
+                    info = _first_entry(ydl.extract_info(
+                        query if video_id is None else f'https://www.youtube.com/watch?v={video_id}', download=False))
+            except YoutubeDlExtractionError:
+                pass
 
-            status['returncode'] = 0
-            self.completed += 1
-            self.logger.info(f'Downloaded {self.completed} / {self.queue_size} -> {str(track)}')
-            return status
+            if info is not None:
+                break
+
+            if video_id is not None:
+                # The video is gone, pick another one on the next attempt.
+                if known and self.resolution_cache is not None:
+                    self.resolution_cache.invalidate(track.recording_id)
+                rejected.add(video_id)
+                video_id, known = None, False
+
+            if attempt > self.retry:
+                return self._finish_job(job, 1, 'Failed to find song.')
+
+            time.sleep(backoff(attempt))
+
+        if info.get('extractor_key') == 'Youtube':
+            if cacheable and not known:
+                self.resolution_cache.put(track.recording_id, info['id'])
+            self._update_journal(track, JobState.RESOLVED, video_id=info['id'])
+        else:
+            self._update_journal(track, JobState.RESOLVED)
+
+        job['info'] = info
+        return job
+
+    def _search(self, track: Track, options: dict, rejected: set):
+        """Returns the id of the search result that best matches the track, only fetching the results' metadata."""
+        from youtube_dl import YoutubeDL
+
+        self.rate_limiter.acquire(Upstream.SEARCH)
+        try:
+            with YoutubeDL({**options, 'extract_flat': 'in_playlist'}) as ydl:
+                results = ydl.extract_info(f'ytsearch{SEARCH_RESULTS}:{str(track)} audio', download=False)
+        except YoutubeDlExtractionError:
+            return None
+
+        candidates = [entry for entry in (results or dict()).get('entries') or list()
+                      if entry and entry.get('id') and entry['id'] not in rejected]
+        best = best_candidate(track, candidates)
+        return best['id'] if best is not None else None
+
+    def _fetch(self, job: dict) -> dict:
+        """Downloads the resolved media into the temp directory."""
+        from youtube_dl import YoutubeDL
+
+        if 'source' in job:
+            return job
+
+        track = job['track']
+        downloaded = list()
+
+        def hook(data) -> None:
+            if data['status'] == 'finished':
+                downloaded.append(data['filename'])
+
+        options = self._ydl_options(track)
+        options['progress_hooks'] = [*options['progress_hooks'], hook]
 
         attempt = 0
         while True:
             attempt += 1
-            cover_art_name = f'{track.album_name} - {track.artists[0]}'
-
-            if cover_art_name in self.downloaded_cover_art:
-                cover_art = self.downloaded_cover_art[cover_art_name]
-            else:
-                cover_art = self.path_holder.download_file(track.cover_art_url, extension='jpg')
-                self.downloaded_cover_art[cover_art_name] = cover_art
-
-            ffmpeg = FFmpeg(executable=self.ffmpeg_location,
-                            inputs={str(output_temp): None, str(cover_art): None, },
-                            outputs={
-                                str(
-                                    output): '-loglevel quiet -hide_banner -y -map 0:0 -map 1:0 -c copy -id3v2_version 3 '
-                                             '-metadata:s:v title="Album cover" -metadata:s:v comment="Cover (front)" '
-                                # '-af "silenceremove=start_periods=1:start_duration=1:start_threshold=-60dB:'
-                                # 'detection=peak,aformat=dblp,areverse,silenceremove=start_periods=1:'
-                                # 'start_duration=1:start_threshold=-60dB:'
-                                # 'detection=peak,aformat=dblp,areverse"'
-                            }
-                            )
 
+            self.rate_limiter.acquire(Upstream.MEDIA)
             try:
-                ffmpeg.run()
+                with YoutubeDL(options) as ydl:
+                    ydl.process_ie_result(dict(job['info']), download=True)
+            except YoutubeDlExtractionError:
+                pass
+
+            if downloaded and check_file(Path(downloaded[-1])):
                 break
 
-            except FFRuntimeError:
-                if attempt > self.retry:
-                    try:
-                        move(output_temp, output)
-                        break
+            if attempt > self.retry:
+                return self._finish_job(job, 1, 'Failed to download song.')
 
-                    except ShutilError:
-                        status['returncode'] = 1
-                        status['error'] = 'Filesystem error.'
-                        self.logger.error('Failed to move temp file!')
-                        self.completed += 1
-                        return status
+            time.sleep(backoff(attempt))
 
-        status['returncode'] = 0
-        try:
-            from os import remove
-            remove(output_temp)
+        job['source'] = downloaded[-1]
+        self._update_journal(track, JobState.DOWNLOADED, source=job['source'], acodec=job['info'].get('acodec'))
+        return job
 
-        except OSError:
-            pass
+    def _transcode(self, job: dict) -> dict:
+        """Converts the downloaded media to the output format, then tags and moves it into place."""
+        track = job['track']
+        output = job['location']
+        output_temp = self.path_holder.get_temp_dir() / f'{track.recording_id}.out.{self.download_format}'
 
-        self.completed += 1
+        options = audio_options(self.download_format, self.quality, job['info'].get('acodec')) + [
+            '-write_id3v1', '1',
+            '-id3v2_version', '3',
+            '-metadata', f'title={track.name}',
+            '-metadata', f'album={track.album_name}',
+            '-metadata', f'date={track.release_date}',
+            '-metadata', f'artist={"/".join(track.artists)}',
+            '-metadata', f'disc={track.disc_number}',
+            '-metadata', f'track={track.track_number}/{track.album_track_count}',
+        ]
+
+        cover_art = None
+        if self.download_format == Format.MP3 and not self.skip_cover_art:
+            cover_art = str(self._get_cover_art(track))
+
+        create_dir(output.parent)
+
+        try:
+            self.transcoder.run(transcode, self.ffmpeg_location, job['source'], str(output_temp), str(output),
+                                options, cover_art, self.retry, self.single_pass, self.transcoder.niceness)
+        except FFmpegConversionError:
+            return self._finish_job(job, 1, 'Failed to convert song.')
+        except (ShutilError, OSError):
+            return self._finish_job(job, 1, 'Filesystem error.')
+
+        return self._finish_download(job)
+
+    def _get_cover_art(self, track: Track) -> Path:
+        download = partial(self.path_holder.download_file, extension='jpg', session=self.session)
+        if self.cover_art_cache is None:
+            return download(track.cover_art_url)
+
+        return self.cover_art_cache.get(track.cover_art_url, download)
+
+    def _finish_download(self, job: dict) -> dict:
+        track = job['track']
+        self._record_download(track, job['location'])
+        self._finish_job(job, 0)
         self.logger.info(f'Downloaded {self.completed} / {self.queue_size} -> {str(track)}')
-        return status
+        return job
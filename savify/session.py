@@ -0,0 +1,72 @@
+"""The HTTP session shared by everything Savify downloads outside of youtube-dl."""
+
+__all__ = ['RateLimitedSession', 'create_session']
+
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .ratelimit import RateLimiter, backoff, retry_after
+from .types import Upstream
+
+DEFAULT_POOL_SIZE = 16
+
+# Seconds to wait for a connection and then for each read.
+DEFAULT_TIMEOUT = (5, 30)
+
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+HOSTS = {
+    'api.spotify.com': Upstream.SPOTIFY,
+    'accounts.spotify.com': Upstream.SPOTIFY,
+    'i.scdn.co': Upstream.COVER_ART,
+}
+
+
+class RateLimitedSession(requests.Session):
+    """A requests session that throttles each request by the upstream it goes to.
+
+    Responses asking us to slow down are retried after an exponential backoff, during which every other
+    request to the same upstream waits as well. Requests made without a timeout use the session's.
+    """
+
+    def __init__(self, rate_limiter: RateLimiter, retries: int = 3, timeout=None) -> None:
+        super().__init__()
+        self.rate_limiter = rate_limiter
+        self.retries = retries
+        self.timeout = timeout
+
+    def request(self, method, url, *args, **kwargs):
+        if kwargs.get('timeout') is None:
+            kwargs['timeout'] = self.timeout
+
+        upstream = HOSTS.get(urlparse(url).hostname)
+        if upstream is None:
+            return super().request(method, url, *args, **kwargs)
+
+        attempt = 0
+        while True:
+            self.rate_limiter.acquire(upstream)
+            response = super().request(method, url, *args, **kwargs)
+            if response.status_code not in RETRY_STATUSES or attempt >= self.retries:
+                return response
+
+            # Give the connection back to the pool, a streamed response would hold on to it otherwise.
+            response.close()
+            attempt += 1
+            self.rate_limiter.pause(upstream, backoff(attempt, retry_after(response.headers)))
+
+
+def create_session(rate_limiter: RateLimiter = None, pool_size: int = None, timeout=None,
+                   retries: int = 3) -> RateLimitedSession:
+    """Returns a keep-alive session that holds up to pool_size open connections to each host.
+
+    Cover art comes from the same image CDN for every song, so reusing connections saves a TCP and TLS
+    handshake per track.
+    """
+    session = RateLimitedSession(rate_limiter or RateLimiter(), retries=retries, timeout=timeout or DEFAULT_TIMEOUT)
+    adapter = HTTPAdapter(pool_maxsize=pool_size or DEFAULT_POOL_SIZE)
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
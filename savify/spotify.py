@@ -1,154 +1,296 @@
+from functools import partial
+from multiprocessing.dummy import Pool as ThreadPool
+
 import spotipy
 from spotipy.oauth2 import SpotifyClientCredentials
 
+from .cache import MetadataCache
+from .link import parse_link
 from .track import Track
 from .types import Type
 
+# Most albums the multiple albums endpoint will return per request.
+ALBUMS_PER_REQUEST = 20
+
+# Most tracks the multiple tracks endpoint will return per request.
+TRACKS_PER_REQUEST = 50
+
 
 class Spotify:
-    def __init__(self, api_credentials=None) -> None:
+    def __init__(self, api_credentials=None, page_workers: int = 8, cache: MetadataCache = None,
+                 requests_session=True, keep_data: bool = False, requests_timeout=5) -> None:
+        self.page_workers = page_workers
+        self.cache = cache
+        self.keep_data = keep_data
+
         if api_credentials is None:
-            self.sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials())
+            credentials = SpotifyClientCredentials(requests_session=requests_session,
+                                                   requests_timeout=requests_timeout)
         else:
             client_id, client_secret = api_credentials
-            self.sp = spotipy.Spotify(client_credentials_manager=SpotifyClientCredentials(
-                client_id=client_id, client_secret=client_secret))
+            credentials = SpotifyClientCredentials(client_id=client_id, client_secret=client_secret,
+                                                   requests_session=requests_session,
+                                                   requests_timeout=requests_timeout)
+
+        self.sp = spotipy.Spotify(client_credentials_manager=credentials, requests_session=requests_session,
+                                  requests_timeout=requests_timeout)
 
     def search(self, query, query_type=Type.TRACK, artist_albums: bool = False) -> list:
+        return [track for page in self.iter_search(query, query_type=query_type, artist_albums=artist_albums)
+                for track in page]
+
+    def iter_search(self, query, query_type=Type.TRACK, artist_albums: bool = False):
+        """Like search, but yields the tracks a page at a time as they are fetched."""
         results = self.sp.search(q=query, limit=1, type=query_type)
         if len(results[f'{query_type}s']['items']) > 0:
             if query_type == Type.TRACK:
-                return [Track(results[f'{Type.TRACK}s']['items'][0])]
+                yield [Track(results[f'{Type.TRACK}s']['items'][0], keep_data=self.keep_data)]
 
             elif query_type == Type.ALBUM:
-                return _pack_album(self.sp.album(results[f'{Type.ALBUM}s']['items'][0]['id']))
+                yield _pack_album(self._get_album(results[f'{Type.ALBUM}s']['items'][0]['id']), self.keep_data)
 
             elif query_type == Type.PLAYLIST:
-                return self._get_playlist_tracks(results[f'{Type.PLAYLIST}s']['items'][0]['id'])
+                yield from self._iter_playlist_tracks(results[f'{Type.PLAYLIST}s']['items'][0]['id'])
 
             elif query_type == Type.ARTIST:
                 if artist_albums:
-                    albums = self._get_artist_albums(results[f'{Type.ARTIST}s']['items'][0]['id'])
-                    tracks = list()
-                    for album in albums:
-                        tracks.extend(_pack_album(self.sp.album(album['id'])))
-
-                    return tracks
+                    yield from self._iter_artist_album_tracks(results[f'{Type.ARTIST}s']['items'][0]['id'])
 
                 else:
-                    return self._get_artist_top(results[f'{Type.ARTIST}s']['items'][0]['id'])
-
-        else:
-            return list()
+                    yield self._get_artist_top(results[f'{Type.ARTIST}s']['items'][0]['id'])
 
     def link(self, query, artist_albums: bool = False) -> list:
+        return [track for page in self.iter_link(query, artist_albums=artist_albums) for track in page]
+
+    def iter_link(self, query, artist_albums: bool = False):
+        """Like link, but yields the tracks a page at a time as they are fetched.
+
+        The query is a Spotify URI or link, or the (type, id) already parsed from one.
+        """
+        link = parse_link(query) if isinstance(query, str) else query
+        if link is None:
+            return
+
+        link_type, link_id = link
         try:
-            if 'track' in query:
-                return [Track(self.sp.track(query))]
+            if link_type == Type.TRACK:
+                track = self._cached(f'track:{link_id}', partial(self.sp.track, link_id))
+                yield [Track(track, keep_data=self.keep_data)]
 
-            elif 'album' in query:
-                return _pack_album(self.sp.album(query))
+            elif link_type == Type.ALBUM:
+                yield _pack_album(self._get_album(link_id), self.keep_data)
 
-            elif 'playlist' in query:
-                return self._get_playlist_tracks(query)
+            elif link_type == Type.PLAYLIST:
+                yield from self._iter_playlist_tracks(link_id)
 
-            elif 'episode' in query:
-                return [Track(self.sp.episode(query, 'US'), track_type=Type.EPISODE)]
+            elif link_type == Type.EPISODE:
+                yield [Track(self.sp.episode(link_id, 'US'), track_type=Type.EPISODE, keep_data=self.keep_data)]
 
-            elif 'show' in query:
-                return self._get_show_episodes(query)
+            elif link_type == Type.SHOW:
+                yield from self._iter_show_episodes(link_id)
 
-            elif 'artist' in query:
+            elif link_type == Type.ARTIST:
                 if artist_albums:
-                    albums = self._get_artist_albums(query)
-                    tracks = list()
-                    for album in albums:
-                        tracks.extend(_pack_album(self.sp.album(album['id'])))
-
-                    return tracks
+                    yield from self._iter_artist_album_tracks(link_id)
 
                 else:
-                    return self._get_artist_top(query)
+                    yield self._get_artist_top(link_id)
 
-            else:
-                return list()
         except spotipy.exceptions.SpotifyException:
-            return list()
+            return
+
+    def get_playlist_snapshot(self, query, search: bool = False):
+        """Returns the id, snapshot_id, name and owner of the playlist linked or searched for, or None."""
+        try:
+            if search:
+                results = self.sp.search(q=query, limit=1, type=Type.PLAYLIST)[f'{Type.PLAYLIST}s']['items']
+                if len(results) == 0:
+                    return None
+
+                query = results[0]['id']
+
+            return self.sp.playlist(query, fields='id,snapshot_id,name,owner.display_name')
+        except spotipy.exceptions.SpotifyException:
+            return None
+
+    def playlist_tracks(self, playlist_id) -> list:
+        return [track for page in self._iter_playlist_tracks(playlist_id) for track in page]
+
+    def _cached(self, key: str, fetch):
+        """Returns the cached response for key, calling fetch and caching its result on a miss."""
+        if self.cache is None:
+            return fetch()
+
+        data = self.cache.get(key)
+        if data is None:
+            data = _strip_markets(fetch())
+            self.cache.put(key, data)
+
+        return data
+
+    def _iter_pages(self, first_page, fetch_page):
+        """Yields the items of every page of a paging object in order.
+
+        The total is known from the first page, so the remaining pages are requested by offset on a bounded
+        pool of threads while the earlier ones are consumed.
+        """
+        yield first_page['items']
+        if not first_page['next']:
+            return
+
+        limit = first_page['limit']
+        offsets = range(first_page['offset'] + limit, first_page['total'], limit)
+        if not offsets:
+            return
+
+        with ThreadPool(min(self.page_workers, len(offsets))) as pool:
+            for page in pool.imap(lambda offset: fetch_page(limit=limit, offset=offset), offsets):
+                yield page['items']
+
+    def _iter_playlist_tracks(self, playlist_id):
+        if self.cache is not None:
+            # The snapshot id changes whenever the playlist does, so an unchanged playlist is served from the
+            # cache after a single small request, rather than paging through all of its tracks again.
+            snapshot = self.sp.playlist(playlist_id, fields='id,snapshot_id')
+            cached = self.cache.get(f'playlist:{snapshot["id"]}', version=snapshot['snapshot_id'])
+            if cached is not None:
+                yield _pack_playlist(cached, cached['items'], self.keep_data)
+                return
 
-    def _get_playlist_tracks(self, playlist_id) -> list:
         playlist = self.sp.playlist(playlist_id)
-        results = playlist['tracks']
-        tracks = results['items']
-        while results['next']:
-            results = self.sp.next(results)
-            tracks.extend(results['items'])
+        fetch_page = partial(self.sp.playlist_items, playlist['id'], additional_types=('track',))
+        tracks = list()
 
-        playlist['tracks'] = tracks
+        for items in self._iter_pages(playlist['tracks'], fetch_page):
+            tracks.extend(items)
+            yield _pack_playlist(playlist, items, self.keep_data)
 
-        return _pack_playlist(playlist)
+        if self.cache is not None:
+            self.cache.put(f'playlist:{playlist["id"]}', _strip_markets({
+                'name': playlist['name'],
+                'owner': {'display_name': playlist['owner']['display_name']},
+                'items': tracks,
+            }), version=playlist['snapshot_id'])
 
-    def _get_show_episodes(self, show_id) -> list:
+    def _iter_show_episodes(self, show_id):
         show = self.sp.show(show_id, 'US')
-        results = show['episodes']
-        episodes = results['items']
-        while results['next']:
-            results = self.sp.next(results)
-            episodes.extend(results['items'])
+        fetch_page = partial(self.sp.show_episodes, show['id'], market='US')
 
-        show['episodes'] = episodes
-
-        return _pack_show(show)
+        for items in self._iter_pages(show['episodes'], fetch_page):
+            yield _pack_show(show, items, self.keep_data)
 
     def _get_artist_albums(self, artist_id):
-        results = self.sp.artist_albums(artist_id, album_type='album')
-        albums = results['items']
-        while results['next']:
-            results = self.sp.next(results)
-            albums.extend(results['items'])
-
-        results = self.sp.artist_albums(artist_id, album_type='single')
-        albums.extend(results['items'])
-        while results['next']:
-            results = self.sp.next(results)
-            albums.extend(results['items'])
+        return self._cached(f'artist-albums:{artist_id}', partial(self._fetch_artist_albums, artist_id))
+
+    def _fetch_artist_albums(self, artist_id):
+        albums = list()
+        for album_type in ('album', 'single'):
+            fetch_page = partial(self.sp.artist_albums, artist_id, album_type=album_type)
+            for items in self._iter_pages(fetch_page(limit=50, offset=0), fetch_page):
+                albums.extend(items)
 
         return albums
 
+    def _iter_artist_album_tracks(self, artist_id):
+        ids = list()
+        for album in self._get_artist_albums(artist_id):
+            cached = self.cache.get(f'album:{album["id"]}') if self.cache is not None else None
+            if cached is not None:
+                yield _pack_album(cached, self.keep_data)
+            else:
+                ids.append(album['id'])
+
+        batches = [ids[i:i + ALBUMS_PER_REQUEST] for i in range(0, len(ids), ALBUMS_PER_REQUEST)]
+        if not batches:
+            return
+
+        with ThreadPool(min(self.page_workers, len(batches))) as pool:
+            for albums in pool.imap(self._fetch_albums, batches):
+                for album in albums:
+                    yield _pack_album(album, self.keep_data)
+
+    def _fetch_albums(self, ids) -> list:
+        """Fetches a batch of albums and completes them together, run on the page pool."""
+        albums = [album for album in self.sp.albums(ids)['albums'] if album is not None]
+        return self._complete_albums(albums, parallel=False)
+
+    def _get_album(self, album_id):
+        if self.cache is not None:
+            cached = self.cache.get(f'album:{album_id}')
+            if cached is not None:
+                return cached
+
+        return self._complete_albums([self.sp.album(album_id)])[0]
+
+    def _complete_albums(self, albums: list, parallel: bool = True) -> list:
+        """Pages through the rest of the albums' tracks, fills in their ISRCs and caches the whole albums."""
+        for album in albums:
+            fetch_page = partial(self.sp.album_tracks, album['id'])
+            tracks = [track for items in self._iter_pages(album['tracks'], fetch_page) for track in items]
+            album['tracks'] = {'items': tracks, 'limit': len(tracks), 'offset': 0, 'total': len(tracks),
+                               'next': None}
+
+        self._add_external_ids([track for album in albums for track in album['tracks']['items']], parallel)
+
+        if self.cache is not None:
+            for album in albums:
+                self.cache.put(f'album:{album["id"]}', _strip_markets(album))
+
+        return albums
+
+    def _add_external_ids(self, tracks: list, parallel: bool = True) -> None:
+        """Fills in the ISRCs that the album endpoints leave out of their simplified track objects."""
+        ids = [track['id'] for track in tracks if track.get('id') and 'external_ids' not in track]
+        batches = [ids[i:i + TRACKS_PER_REQUEST] for i in range(0, len(ids), TRACKS_PER_REQUEST)]
+        if not batches:
+            return
+
+        if parallel and len(batches) > 1:
+            with ThreadPool(min(self.page_workers, len(batches))) as pool:
+                pages = pool.map(self.sp.tracks, batches)
+        else:
+            pages = map(self.sp.tracks, batches)
+
+        external_ids = dict()
+        for results in pages:
+            external_ids.update((track['id'], track['external_ids']) for track in results['tracks']
+                                if track is not None and 'external_ids' in track)
+
+        for track in tracks:
+            if track.get('id') in external_ids:
+                track['external_ids'] = external_ids[track['id']]
+
     def _get_artist_top(self, artist_id):
         tracks = list()
-        for track in self.sp.artist_top_tracks(artist_id)['tracks']:
-            tracks.append(Track(track))
+        top_tracks = self._cached(f'artist-top:{artist_id}', partial(self.sp.artist_top_tracks, artist_id))
+        for track in top_tracks['tracks']:
+            tracks.append(Track(track, keep_data=self.keep_data))
 
         return tracks
 
 
-def _pack_album(album) -> list:
-    tracks = list()
-    for track in album['tracks']['items']:
-        track_data = track
-        track_data['album'] = album
-        tracks.append(Track(track_data))
+def _strip_markets(data):
+    """Drops the available_markets lists, which make up most of a cached response but are never used."""
+    if isinstance(data, dict):
+        data.pop('available_markets', None)
+        for value in data.values():
+            _strip_markets(value)
+    elif isinstance(data, list):
+        for value in data:
+            _strip_markets(value)
 
-    return tracks
+    return data
 
 
-def _pack_show(show) -> list:
-    episodes = list()
-    for episode in show['episodes']:
-        episode_data = episode
-        episode_data['show'] = show
-        episodes.append(Track(episode_data, track_type=Type.EPISODE))
+def _pack_album(album, keep_data: bool = False) -> list:
+    return Track.from_items(album['tracks']['items'], {'album': album}, keep_data=keep_data)
 
-    return episodes
 
+def _pack_show(show, episodes, keep_data: bool = False) -> list:
+    return Track.from_items(episodes, {'show': show}, track_type=Type.EPISODE, keep_data=keep_data)
 
-def _pack_playlist(playlist) -> list:
-    tracks = list()
-    for track in playlist['tracks']:
-        if track is not None:
-            track_data = track['track']
-            if track_data is not None:
-                track_data['playlist'] = f"{playlist['name']} - {playlist['owner']['display_name']}"
-                tracks.append(Track(track_data))
 
-    return tracks
+def _pack_playlist(playlist, items, keep_data: bool = False) -> list:
+    tracks = [item['track'] for item in items if item is not None and item['track'] is not None]
+    return Track.from_items(tracks, {'playlist': f"{playlist['name']} - {playlist['owner']['display_name']}"},
+                            keep_data=keep_data)
@@ -1,96 +1,157 @@
-from typing import Callable
 from uuid import uuid1
 
 from .types import Type, Platform
 
+DEFAULT_COVER_ART_URL = 'https://developer.spotify.com/assets/branding-guidelines/icon3@2x.png'
+
+# Album name, artists and name used when a payload leaves them out.
+_DEFAULTS = {
+    Type.TRACK: ('Unknown Album', ('Unknown Artist',), 'Unknown Song'),
+    Type.EPISODE: ('Unknown Show', ('Unknown Publisher',), 'Unknown Episode'),
+}
+
+_EMPTY = dict()
+
 
 class Track:
-    def try_with_key_error(self, name: str, getter: Callable, default: str = '') -> None:
-        """Wraps a try-except-assign statement."""
-        try:
-            setattr(self, name, getter())
-        except KeyError:
-            setattr(self, name, default)
-
-    def __init__(self, spotify_data, track_type=Type.TRACK) -> None:
-        self.album_track_count = None
-        self.track_number = None
-        self.release_date = None
-        self.disc_number = None
-        self.playlist = None
-        self.name = None
-        self.uri = None
-        self.url = None
-        self.id = None
-
-        self.platform = Platform.SPOTIFY
-        self.track_type = track_type
-        self._data = spotify_data
-
-        try:
-            self.album_name = spotify_data['album']['name']
-        except KeyError:
-            try:
-                self.album_name = spotify_data['show']['name']
-            except KeyError:
-                self.album_name = 'Unknown Show' if track_type == Type.EPISODE else 'Unknown Album'
-
-        try:
-            self.artists = _spotify_artist_names(spotify_data['artists'])
-        except KeyError:
-            try:
-                self.artists = [spotify_data['show']['publisher']]
-            except KeyError:
-                self.artists = ['Unknown Publisher' if track_type == Type.EPISODE else 'Unknown Artist']
-
-        try:
-            self.cover_art_url = spotify_data['album']['images'][0]['url']
-        except (KeyError, IndexError):
-            try:
-                self.cover_art_url = spotify_data['images'][0]['url']
-            except (KeyError, IndexError):
-                self.cover_art_url = 'https://developer.spotify.com/assets/branding-guidelines/icon3@2x.png'
-
-        self.try_with_key_error("id",
-                                lambda: spotify_data['id'],
-                                default=str(uuid1()))
-
-        self.try_with_key_error("name",
-                                lambda: spotify_data['name'],
-                                default='Unknown Episode' if track_type == Type.EPISODE else 'Unknown Song')
-
-        self.try_with_key_error("url",
-                                lambda: spotify_data['external_urls']['spotify'])
-
-        self.try_with_key_error("album_track_count",
-                                lambda: spotify_data['album']['total_tracks'])
-
-        self.try_with_key_error("release_date",
-                                lambda: spotify_data['album']['release_date'])
-
-        self.try_with_key_error("track_number",
-                                lambda: spotify_data['track_number'])
-
-        self.try_with_key_error("disc_number",
-                                lambda: spotify_data['disc_number'])
-
-        self.try_with_key_error("playlist",
-                                lambda: spotify_data['playlist'])
-
-        self.try_with_key_error("uri",
-                                lambda: spotify_data['uri'])
+    """An immutable record of the fields Savify uses from a Spotify track or episode.
+
+    The raw Spotify data is dropped once parsed, as it often holds the whole album or show the track came
+    from. Pass keep_data=True to keep it available as ``data``.
+    """
+
+    __slots__ = ('id', 'name', 'artists', 'album_name', 'album_track_count', 'track_number', 'disc_number',
+                 'release_date', 'duration_ms', 'isrc', 'cover_art_url', 'playlist', 'url', 'uri', 'platform',
+                 'track_type', 'data')
+
+    def __init__(self, spotify_data, track_type=Type.TRACK, keep_data: bool = False) -> None:
+        _fill(self, _values(spotify_data, None, None, '', _parse_parent(None, None, track_type), track_type,
+                            keep_data))
+
+    @classmethod
+    def from_items(cls, items, context: dict = None, track_type=Type.TRACK, keep_data: bool = False) -> list:
+        """Builds the tracks of a page of Spotify items in one pass.
+
+        context holds the fields the items share, i.e. the ``album`` of an album's tracks, the ``show`` of a
+        show's episodes or the ``playlist`` name of a playlist's tracks. It is parsed once for the whole page,
+        and an item's own fields take precedence over it.
+        """
+        context = context or _EMPTY
+        album, show, playlist = context.get('album'), context.get('show'), context.get('playlist', '')
+        shared = _parse_parent(album, show, track_type)
+        new = object.__new__
+
+        tracks = list()
+        for item in items:
+            track = new(cls)
+            _fill(track, _values(item, album, show, playlist, shared, track_type, keep_data))
+            tracks.append(track)
+
+        return tracks
+
+    def __setattr__(self, name, value) -> None:
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __delattr__(self, name) -> None:
+        raise AttributeError(f'{type(self).__name__} is immutable')
+
+    def __getstate__(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __setstate__(self, state) -> None:
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    @property
+    def recording_id(self) -> str:
+        """The ISRC if known, so the same recording released on several albums is downloaded once, else the id."""
+        return self.isrc or self.id
 
     def __repr__(self) -> str:
         return f'{self.id}\nName: {self.name}\nArtists: {self.artists}\nAlbum: {self.album_name}\n' \
                f'Release Date: {self.release_date}\nTrack: {self.track_number} / {self.album_track_count}\n' \
-               f'Disc: {self.disc_number}\nCover Art: {self.cover_art_url}\nLink: {self.url}\nUri: {self.uri}'
+               f'Disc: {self.disc_number}\nCover Art: {self.cover_art_url}\nLink: {self.url}\nUri: {self.uri}\n' \
+               f'ISRC: {self.isrc}'
 
     def __str__(self) -> str:
         return f'{self.artists[0]} - {self.name}'
 
 
-def _spotify_artist_names(artist_data) -> list:
+# The slots' own setters, which get around Track.__setattr__.
+_SETTERS = tuple(getattr(Track, name).__set__ for name in Track.__slots__)
+
+
+def _fill(track: Track, values: tuple) -> None:
+    for setter, value in zip(_SETTERS, values):
+        setter(track, value)
+
+
+def _parse_parent(album, show, track_type) -> tuple:
+    """Returns the album name, fallback artists, cover art, track count and release date of an album or show."""
+    album_name, artists, _ = _DEFAULTS[track_type]
+    cover_art_url, album_track_count, release_date = None, '', ''
+
+    if album is not None and 'name' in album:
+        album_name = album['name']
+    elif show is not None and 'name' in show:
+        album_name = show['name']
+
+    if show is not None and 'publisher' in show:
+        artists = (show['publisher'],)
+
+    if album is not None:
+        cover_art_url = _first_image(album)
+        album_track_count = album.get('total_tracks', '')
+        release_date = album.get('release_date', '')
+
+    return album_name, artists, cover_art_url, album_track_count, release_date
+
+
+def _values(item: dict, album, show, playlist: str, shared: tuple, track_type, keep_data: bool) -> tuple:
+    """Returns the values of every Track slot, in order, reusing shared unless the item has its own parent."""
+    item_album, item_show = item.get('album', album), item.get('show', show)
+    if item_album is not album or item_show is not show:
+        shared = _parse_parent(item_album, item_show, track_type)
+
+    album_name, artists, cover_art_url, album_track_count, release_date = shared
+    if 'artists' in item:
+        artists = _spotify_artist_names(item['artists'])
+
+    if cover_art_url is None:
+        cover_art_url = _first_image(item) or DEFAULT_COVER_ART_URL
+
+    isrc = item.get('external_ids', _EMPTY).get('isrc')
+
+    return (
+        item['id'] if 'id' in item else str(uuid1()),
+        item['name'] if 'name' in item else _DEFAULTS[track_type][2],
+        artists,
+        album_name,
+        album_track_count,
+        item.get('track_number', ''),
+        item.get('disc_number', ''),
+        release_date,
+        item.get('duration_ms'),
+        isrc.replace('-', '').upper() if isrc else None,
+        cover_art_url,
+        item.get('playlist', playlist),
+        item.get('external_urls', _EMPTY).get('spotify', ''),
+        item.get('uri', ''),
+        Platform.SPOTIFY,
+        track_type,
+        item if keep_data else None,
+    )
+
+
+def _first_image(data: dict):
+    try:
+        return data['images'][0]['url']
+    except (KeyError, IndexError):
+        return None
+
+
+def _spotify_artist_names(artist_data) -> tuple:
     try:
-        return [artist['name'] for artist in artist_data]
+        return tuple(artist['name'] for artist in artist_data)
     except KeyError:
-        return ['Unknown Artist']
+        return ('Unknown Artist',)
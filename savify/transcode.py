@@ -0,0 +1,193 @@
+"""FFmpeg transcoding jobs and the engine that schedules them."""
+
+__all__ = ['Transcoder', 'audio_options', 'transcode']
+
+import os
+import shlex
+from functools import partial
+from shutil import move, which
+from subprocess import PIPE
+from threading import Lock
+
+from .types import Engine, Format
+from .exceptions import FFmpegConversionError
+
+CODECS = {
+    Format.MP3: 'libmp3lame',
+    Format.AAC: 'aac',
+    Format.FLAC: 'flac',
+    Format.M4A: 'aac',
+    Format.OPUS: 'libopus',
+    Format.VORBIS: 'libvorbis',
+    Format.WAV: None,
+}
+
+# Source codecs (as reported by youtube-dl) that can be copied into each format without re-encoding.
+COPYABLE = {
+    Format.AAC: ('mp4a',),
+    Format.M4A: ('mp4a',),
+    Format.OPUS: ('opus',),
+    Format.VORBIS: ('vorbis',),
+}
+
+COVER_ART_OPTIONS = ['-id3v2_version', '3', '-metadata:s:v', 'title=Album cover',
+                     '-metadata:s:v', 'comment=Cover (front)']
+
+MUXERS = {
+    Format.AAC: 'adts',
+    Format.VORBIS: 'ogg',
+    Format.WAV: 'wav',
+}
+
+
+def audio_options(download_format: str, quality: str, source_codec: str = None) -> list:
+    """Builds the ffmpeg output options FFmpegExtractAudio would use to convert audio to the given format."""
+    options = list()
+
+    if source_codec and source_codec.startswith(COPYABLE.get(download_format, ())):
+        options += ['-acodec', 'copy']
+    else:
+        if CODECS[download_format] is not None:
+            options += ['-acodec', CODECS[download_format]]
+
+        if quality is not None and download_format not in {Format.FLAC, Format.WAV}:
+            if int(quality) < 10:
+                # The opus codec doesn't support the -aq option
+                if download_format != Format.OPUS:
+                    options += ['-q:a', quality]
+            else:
+                options += ['-b:a', f'{quality}k']
+
+    if download_format == Format.M4A:
+        options += ['-bsf:a', 'aac_adtstoasc']
+
+    if download_format in MUXERS:
+        options += ['-f', MUXERS[download_format]]
+
+    return options
+
+
+def transcode(ffmpeg_location: str, source: str, temp: str, output: str, options: list,
+              cover_art: str = None, retry: int = 3, single_pass: bool = False, niceness: int = 0) -> str:
+    """Converts source to output, muxing in the cover art if given. Safe to run in a worker process.
+
+    FFmpeg runs with niceness added to its priority, where the platform has nice(1).
+    """
+    run = partial(_run, niceness=niceness)
+    if single_pass:
+        try:
+            return _transcode_single_pass(run, ffmpeg_location, source, output, options, cover_art)
+        except FFmpegConversionError:
+            if cover_art is None:
+                raise
+            # Fall back to two passes, so the song is still saved if only the cover art is at fault.
+
+    run(ffmpeg_location, {source: None}, temp, ['-vn', *options])
+    _remove(source)
+
+    if cover_art is None:
+        move(temp, output)
+        return output
+
+    attempt = 0
+    while True:
+        attempt += 1
+
+        try:
+            run(ffmpeg_location, {temp: None, cover_art: None}, output,
+                ['-map', '0:0', '-map', '1:0', '-c', 'copy', *COVER_ART_OPTIONS])
+            break
+
+        except FFmpegConversionError:
+            if attempt > retry:
+                move(temp, output)
+                return output
+
+    _remove(temp)
+    return output
+
+
+def _transcode_single_pass(run, ffmpeg_location: str, source: str, output: str, options: list,
+                           cover_art: str = None) -> str:
+    """Converts, tags and adds the cover art with one ffmpeg run, writing next to the final output."""
+    root, extension = os.path.splitext(output)
+    partial_output = f'{root}.part{extension}'
+
+    if cover_art is None:
+        inputs = {source: None}
+        options = ['-vn', *options]
+    else:
+        inputs = {source: None, cover_art: None}
+        options = ['-map', '0:a:0', '-map', '1:0', *options, '-c:v', 'copy', *COVER_ART_OPTIONS]
+
+    try:
+        run(ffmpeg_location, inputs, partial_output, options)
+        os.replace(partial_output, output)
+    except (FFmpegConversionError, OSError):
+        _remove(partial_output)
+        raise
+
+    _remove(source)
+    return output
+
+
+def _remove(path: str) -> None:
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def _run(ffmpeg_location: str, inputs: dict, output: str, options: list, niceness: int = 0) -> None:
+    from ffmpy import FFmpeg, FFRuntimeError
+
+    executable, global_options = ffmpeg_location, ['-loglevel', 'error', '-hide_banner', '-y']
+    if niceness and which('nice'):
+        # Run through nice(1), as a preexec_fn can deadlock a child forked while other threads are running.
+        executable, global_options = 'nice', ['-n', str(niceness), shlex.quote(ffmpeg_location), *global_options]
+
+    ffmpeg = FFmpeg(executable=executable,
+                    global_options=global_options,
+                    inputs=inputs,
+                    outputs={output: options})
+
+    try:
+        ffmpeg.run(stdout=PIPE, stderr=PIPE)
+    except FFRuntimeError as ex:
+        raise FFmpegConversionError(f'FFmpeg failed to convert the song! [exit code {ex.exit_code}]')
+
+
+class Transcoder:
+    """Runs transcoding jobs on a fixed number of job slots, in threads or in separate worker processes."""
+
+    def __init__(self, workers: int, engine: str = Engine.THREAD, niceness: int = 0) -> None:
+        self.workers = workers
+        self.engine = engine
+        self.niceness = niceness
+        self._executor = None
+        self._lock = Lock()
+
+    def run(self, function, *args):
+        """Runs the job on the engine and blocks until it is done, re-raising any error it hit."""
+        return self._get_executor().submit(function, *args).result()
+
+    def shutdown(self) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown()
+                self._executor = None
+
+    def _get_executor(self):
+        with self._lock:
+            if self._executor is None:
+                if self.engine == Engine.PROCESS:
+                    from concurrent.futures import ProcessPoolExecutor
+                    from multiprocessing import get_context
+
+                    # Worker processes are spawned so they don't inherit the downloader threads' state.
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=get_context('spawn'))
+                else:
+                    from concurrent.futures import ThreadPoolExecutor
+                    self._executor = ThreadPoolExecutor(self.workers, thread_name_prefix='savify-ffmpeg')
+
+            return self._executor
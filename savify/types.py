@@ -1,4 +1,4 @@
-__all__ = ['Type', 'Platform', 'Format', 'Quality']
+__all__ = ['Type', 'Platform', 'Format', 'Quality', 'Engine', 'Upstream', 'LinkMode', 'JobState']
 
 
 class Type:
@@ -34,3 +34,29 @@ class Quality:
     Q256K = '256'
     Q320K = '320'
     BEST = '0'
+
+
+class Engine:
+    THREAD = 'thread'
+    PROCESS = 'process'
+
+
+class Upstream:
+    SPOTIFY = 'spotify'
+    SEARCH = 'search'
+    MEDIA = 'media'
+    COVER_ART = 'cover-art'
+
+
+class LinkMode:
+    HARDLINK = 'hardlink'
+    SYMLINK = 'symlink'
+    COPY = 'copy'
+
+
+class JobState:
+    QUEUED = 'queued'
+    RESOLVED = 'resolved'
+    DOWNLOADED = 'downloaded'
+    DONE = 'done'
+    FAILED = 'failed'
@@ -1,17 +1,22 @@
 import os
 
+from functools import lru_cache
 from pathlib import Path
-from shutil import rmtree
+from shutil import copy2, rmtree
 from sys import platform
 from uuid import uuid1
-from urllib.request import urlretrieve
-import re
+
+from .types import LinkMode
 
 __all__ = ['PathHolder']
 
 
-def clean(path) -> None:
+def clean(path, keep: set = None) -> None:
+    """Empties the directory, except for files named after an id in keep (e.g. <id>.webm.part)."""
     for file in os.listdir(path):
+        if keep and file.split('.')[0] in keep:
+            continue
+
         file_path = os.path.join(path, file)
         try:
             if os.path.isfile(file_path) or os.path.islink(file_path):
@@ -23,6 +28,38 @@ def clean(path) -> None:
             print('Failed to delete %s. Reason: %s' % (file_path, e))
 
 
+def link_file(source, destination, mode: str = LinkMode.COPY) -> None:
+    """Makes destination a hardlink, symlink or copy of source, copying if the link can't be made."""
+    if mode == LinkMode.HARDLINK:
+        try:
+            os.link(source, destination)
+            return
+        except OSError:
+            pass
+
+    elif mode == LinkMode.SYMLINK:
+        try:
+            os.symlink(os.path.abspath(source), destination)
+            return
+        except OSError:
+            pass
+
+    copy2(source, destination)
+
+
+def connect(location: Path, timeout: float = 30):
+    """Opens an SQLite database shared by several stores and pipeline threads.
+
+    Write-ahead logging lets readers carry on while another connection writes, and writers wait up to
+    timeout seconds for each other rather than failing with "database is locked".
+    """
+    import sqlite3
+
+    connection = sqlite3.connect(str(location), timeout=timeout, check_same_thread=False)
+    connection.execute('PRAGMA journal_mode=WAL')
+    return connection
+
+
 def create_dir(path: Path) -> None:
     path.mkdir(parents=True, exist_ok=True)
 
@@ -41,17 +78,65 @@ def check_file(path: Path) -> bool:
     return path.is_file()
 
 
-def safe_path_string(string: str) -> str:
-    keep_characters = " !£$%^&()_-+=,.;'@#~[]{}"
-    new_string = ""
+# Punctuation allowed in file names alongside letters and digits, anything else becomes an underscore.
+SAFE_PUNCTUATION = " !£$%^&()_-+=,.;'@#~[]{}"
 
-    for c in string:
-        if c.isalnum() or c in keep_characters:
-            new_string = new_string + c
-        else:
-            new_string = new_string + "_"
+# Most filesystems limit each path component to 255 bytes (ext4, btrfs, APFS) or 255 UTF-16 code units (NTFS).
+MAX_COMPONENT_BYTES = 255
+
+# Room left after a sanitised name for the suffixes Savify adds to it, i.e. ".part" or ".m3u".
+RESERVED_SUFFIX_BYTES = len('.part')
+
+# Longest suffix kept whole when a long name is cut to fit, e.g. the ".flac" of a song's file name.
+MAX_SUFFIX_LENGTH = 8
+
+WINDOWS_RESERVED_NAMES = frozenset({'CON', 'PRN', 'AUX', 'NUL', *(f'COM{i}' for i in range(1, 10)),
+                                    *(f'LPT{i}' for i in range(1, 10))})
 
-    return re.sub(r'\.+$', '', new_string.rstrip()).encode('utf8').decode('utf8')
+RESERVED_NAMES = WINDOWS_RESERVED_NAMES if platform == "win32" else frozenset()
+
+
+class _SafeCharacters(dict):
+    """A str.translate table mapping every character not allowed in a path to an underscore, built as it is used."""
+
+    def __missing__(self, code_point: int):
+        character = chr(code_point)
+        self[code_point] = code_point if character.isalnum() or character in SAFE_PUNCTUATION else '_'
+        return self[code_point]
+
+
+_SAFE_CHARACTERS = _SafeCharacters()
+
+
+@lru_cache(maxsize=4096)
+def safe_path_string(string: str, filesystem: bool = False) -> str:
+    """Replaces the characters not allowed in a path with underscores and strips trailing spaces and dots.
+
+    With filesystem=True, the result is also made a valid path component: it is cut to leave room for
+    RESERVED_SUFFIX_BYTES within MAX_COMPONENT_BYTES, keeping any short suffix, and names reserved by the
+    platform (e.g. CON or LPT1 on Windows) get an underscore appended.
+    """
+    new_string = _strip_end(string.translate(_SAFE_CHARACTERS))
+    if not filesystem:
+        return new_string
+
+    stem, suffix = os.path.splitext(new_string)
+    if len(suffix) > MAX_SUFFIX_LENGTH:
+        stem, suffix = new_string, ''
+
+    if len(new_string.encode('utf8')) > MAX_COMPONENT_BYTES - RESERVED_SUFFIX_BYTES:
+        # Cut on a character boundary, the partial character left at the end is dropped.
+        budget = MAX_COMPONENT_BYTES - RESERVED_SUFFIX_BYTES - len(suffix.encode('utf8'))
+        stem = _strip_end(stem.encode('utf8')[:budget].decode('utf8', 'ignore'))
+
+    if stem.split('.')[0].upper() in RESERVED_NAMES:
+        stem = f'{stem}_' if '.' not in stem else stem.replace('.', '_.', 1)
+
+    return f'{stem}{suffix}'
+
+
+def _strip_end(string: str) -> str:
+    return string.rstrip().rstrip('.')
 
 
 class PathHolder:
@@ -92,10 +177,20 @@ class PathHolder:
     def get_temp_dir(self) -> Path:
         return self.temp_path
 
-    def download_file(self, url: str, extension: str = None) -> Path:
+    def download_file(self, url: str, extension: str = None, session=None) -> Path:
         file_path = self.get_temp_dir() / str(uuid1())
         if extension is not None:
             file_path = file_path.with_suffix(f'.{extension}')
 
-        urlretrieve(url, str(file_path))
+        if session is None:
+            from urllib.request import urlretrieve
+            urlretrieve(url, str(file_path))
+            return file_path
+
+        with session.get(url, stream=True) as response:
+            response.raise_for_status()
+            with open(file_path, 'wb') as file:
+                for chunk in response.iter_content(64 * 1024):
+                    file.write(chunk)
+
         return file_path
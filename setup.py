@@ -7,8 +7,7 @@ from setuptools import setup, find_packages, Extension
 with open('README.rst') as readme_file:
     readme = readme_file.read()
 
-requirements = ['ffmpy>=0.3.0', 'spotipy>=2.16.1', 'tldextract>=3.1.0', 'validators>=0.18.2', 'youtube-dl>=2021.6.6',
-                'requests>=2.25.1', 'click>=7.1.2']
+requirements = ['ffmpy>=0.3.0', 'spotipy>=2.16.1', 'youtube-dl>=2021.6.6', 'requests>=2.25.1', 'click>=7.1.2']
 
 setup_requirements = ['pytest-runner', ]
 
@@ -17,14 +16,13 @@ test_requirements = ['pytest>=3', ]
 setup(
     author="Laurence Rawlings",
     author_email='contact@laurencerawlings.com',
-    python_requires='>=3.6',
+    python_requires='>=3.7',
     classifiers=[
         'Development Status :: 2 - Pre-Alpha',
         'Intended Audience :: Developers',
         'License :: OSI Approved :: MIT License',
         'Natural Language :: English',
         'Programming Language :: Python :: 3',
-        'Programming Language :: Python :: 3.6',
         'Programming Language :: Python :: 3.7',
         'Programming Language :: Python :: 3.8',
     ],
@@ -16,3 +16,850 @@ def test_command_line_interface():
     help_result = runner.invoke(cli.main, ['--help'])
     assert help_result.exit_code == 0
     assert 'Show this message and exit.' in help_result.output
+
+
+def test_download_index(tmp_path):
+    """Test the download index round trip."""
+    from savify.index import DownloadIndex
+
+    song = tmp_path / 'song.mp3'
+    song.write_bytes(b'data')
+
+    index = DownloadIndex(tmp_path / 'index.db')
+    index.add('id1', 'mp3', '0', song)
+    assert index.lookup(['id1', 'id2'], 'mp3', '0') == {'id1': [str(song)]}
+    assert index.lookup(['id1'], 'flac', '0') == {}
+
+    index.remove('id1', 'mp3', '0', song)
+    assert index.lookup(['id1'], 'mp3', '0') == {}
+    index.close()
+
+
+def test_index_deleted_song(tmp_path):
+    """Test a song deleted from the library is downloaded again rather than trusted to the index."""
+    from savify.track import Track
+    from savify.utils import PathHolder
+
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)))
+    track = Track({'id': 'id0', 'name': 'song', 'artists': [{'name': 'art'}]})
+    output = s._output_path(track)
+    output.write_bytes(b'song')
+    s._record_download(track, output)
+    assert s._check_index([track])[0]['returncode'] == 0
+
+    output.unlink()
+    assert s._check_index([track]) == [None]
+    assert s.index.lookup(['id0'], s.download_format, s.quality) == {}
+
+
+def test_resolution_cache(tmp_path):
+    """Test resolution cache hits, expiry and eviction."""
+    from savify.cache import ResolutionCache
+
+    cache = ResolutionCache(tmp_path / 'cache.db', max_entries=1)
+    assert cache.get('track') is None
+    cache.put('track', 'video')
+    assert cache.get('track') == 'video'
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.ttl = -1
+    assert cache.get('track') is None
+
+    cache.ttl = 60
+    cache.put('a', 'video_a')
+    cache.put('b', 'video_b')
+    cache._evict()
+    assert cache.get('a') is None
+    assert cache.get('b') == 'video_b'
+    cache.close()
+
+
+def test_pipeline_stages():
+    """Test jobs pass through every stage and finished jobs skip the rest."""
+    from savify.pipeline import Pipeline, Stage
+
+    def first(job):
+        job['seen'] = ['first']
+        if job['fail']:
+            job['returncode'] = 1
+        return job
+
+    def second(job):
+        job['seen'].append('second')
+        job['returncode'] = 0
+        return job
+
+    def broken(job):
+        raise ValueError('boom')
+
+    jobs = [{'returncode': -1, 'fail': i % 2 == 0} for i in range(20)]
+    finished = list(Pipeline([Stage('first', first, 3), Stage('second', second, 2)]).run(jobs))
+
+    assert len(finished) == 20
+    assert all(job['seen'] == (['first'] if job['fail'] else ['first', 'second']) for job in finished)
+
+    failed = list(Pipeline([Stage('broken', broken, 1)]).run([{'returncode': -1}]))
+    assert failed[0]['returncode'] == 1
+    assert 'boom' in failed[0]['error']
+
+    finished = list()
+    failed = list(Pipeline([Stage('broken', broken, 1, on_error=lambda job, error: finished.append(error) or job)])
+                  .run([{'returncode': -1}]))
+    assert finished == ['Broken failed. [boom]'] and failed[0]['returncode'] == -1
+
+    def locked(job, error):
+        raise RuntimeError('database is locked')
+
+    failed = list()
+    with pytest.raises(RuntimeError, match='locked'):
+        for job in Pipeline([Stage('broken', broken, 2, on_error=locked), Stage('second', second, 1)]).run(
+                [{'returncode': -1} for _ in range(3)]):
+            failed.append(job)
+    assert [job['returncode'] for job in failed] == [1, 1, 1]
+
+
+def test_audio_options():
+    """Test ffmpeg options match the requested format and quality."""
+    from savify.transcode import audio_options
+    from savify.types import Format, Quality
+
+    assert audio_options(Format.MP3, Quality.BEST) == ['-acodec', 'libmp3lame', '-q:a', '0']
+    assert audio_options(Format.MP3, Quality.Q320K) == ['-acodec', 'libmp3lame', '-b:a', '320k']
+    assert audio_options(Format.OPUS, Quality.BEST, 'opus') == ['-acodec', 'copy']
+    assert audio_options(Format.VORBIS, Quality.BEST)[-2:] == ['-f', 'ogg']
+
+
+def test_transcode_niceness(monkeypatch):
+    """Test the niceness is applied to the FFmpeg process itself, so it works with the thread engine too."""
+    import ffmpy
+    from shutil import which
+    from savify import transcode
+
+    commands = list()
+    monkeypatch.setattr(ffmpy.FFmpeg, 'run', lambda self, stdout=None, stderr=None: commands.append(self.cmd))
+    transcode._run('/opt/my ffmpeg/ffmpeg', {'source.webm': None}, 'song.mp3', [], niceness=5)
+    transcode._run('ffmpeg', {'source.webm': None}, 'song.mp3', [])
+
+    if which('nice'):
+        assert commands[0].startswith('nice -n 5 "/opt/my ffmpeg/ffmpeg" -loglevel error')
+    assert commands[1].startswith('ffmpeg -loglevel error')
+
+
+@pytest.mark.parametrize('single_pass', [True, False])
+def test_transcode(tmp_path, monkeypatch, single_pass):
+    """Test transcode converts and adds the cover art in either mode, cleaning up its intermediate files."""
+    from savify import transcode
+
+    def run(ffmpeg_location, inputs, output, options, niceness=0):
+        assert ffmpeg_location == 'ffmpeg' and all(isinstance(path, str) for path in inputs)
+        with open(output, 'wb') as file:
+            file.write(b''.join(open(path, 'rb').read() for path in inputs))
+
+    source, temp, output, cover_art = (str(tmp_path / name) for name in ('song.webm', 'song.tmp', 'song.mp3',
+                                                                         'cover.jpg'))
+    for path, data in ((source, b'audio'), (cover_art, b'image')):
+        with open(path, 'wb') as file:
+            file.write(data)
+
+    monkeypatch.setattr(transcode, '_run', run)
+    assert transcode.transcode('ffmpeg', source, temp, output, [], cover_art, single_pass=single_pass) == output
+    assert open(output, 'rb').read() == b'audioimage'
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['cover.jpg', 'song.mp3']
+
+
+def test_async_savify():
+    """Test the asyncio interface streams every job from the feed through every stage, then its links."""
+    import asyncio
+    from savify.aio import AsyncSavify
+    from savify.pipeline import Pipeline, Stage
+
+    class FakeSavify:
+        queue_size = completed = 0
+
+        class transcoder:
+            shutdown = staticmethod(lambda: None)
+
+        def _start(self):
+            pass
+
+        def _iter_query_jobs(self, queries, query_type, artist_albums, jobs, links=None):
+            for page in ([0, 1, 2], [3, 4]):
+                page_jobs = [{'track': track, 'returncode': 0 if track == 0 else -1} for track in page]
+                jobs.extend(page_jobs)
+                yield from page_jobs
+
+            links.append({'track': 5, 'returncode': -1, 'original': jobs[1]})
+
+        def _finish_link(self, job):
+            job['returncode'] = job.pop('original')['returncode']
+            return job
+
+        def _build_pipeline(self):
+            def finish(job):
+                job['returncode'] = 0
+                return job
+
+            return Pipeline([Stage('resolve', lambda job: job, 2), Stage('transcode', finish, 1)])
+
+    async def collect():
+        async with AsyncSavify(FakeSavify()) as s:
+            return [job async for job in s.download('query')]
+
+    jobs = asyncio.run(collect())
+    assert sorted(job['track'] for job in jobs) == list(range(6))
+    assert all(job['returncode'] == 0 for job in jobs)
+
+
+def test_spotify_pages():
+    """Test pages after the first are fetched by offset and yielded in order."""
+    from savify.spotify import Spotify
+
+    def fetch_page(limit, offset):
+        return {'items': list(range(offset, min(offset + limit, 95)))}
+
+    spotify = Spotify.__new__(Spotify)
+    spotify.page_workers = 4
+    first_page = {'items': list(range(10)), 'limit': 10, 'offset': 0, 'total': 95, 'next': 'next'}
+
+    pages = list(spotify._iter_pages(first_page, fetch_page))
+    assert len(pages) == 10
+    assert [item for page in pages for item in page] == list(range(95))
+
+
+def test_spotify_artist_albums(tmp_path):
+    """Test artist albums are fetched in batches, long albums are fully paged with ISRCs and albums are cached."""
+    from savify.cache import MetadataCache
+    from savify.spotify import Spotify
+
+    def page(items, limit, offset, total):
+        return {'items': items, 'limit': limit, 'offset': offset, 'total': total,
+                'next': 'next' if offset + limit < total else None}
+
+    def album(album_id):
+        total = 120 if album_id == 'a0' else 3
+        tracks = [{'id': f'{album_id}-{i}', 'name': str(i)} for i in range(min(total, 50))]
+        return {'id': album_id, 'name': album_id, 'tracks': page(tracks, 50, 0, total)}
+
+    class FakeSpotipy:
+        batches = list()
+        track_batches = list()
+
+        def artist_albums(self, artist_id, album_type, limit, offset):
+            albums = [{'id': f'a{i}'} for i in range(45)] if album_type == 'album' else []
+            return page(albums[offset:offset + limit], limit, offset, len(albums))
+
+        def albums(self, ids):
+            self.batches.append(ids)
+            return {'albums': [album(album_id) for album_id in ids]}
+
+        def album_tracks(self, album_id, limit, offset):
+            tracks = [{'id': f'{album_id}-{i}', 'name': str(i)} for i in range(offset, min(offset + limit, 120))]
+            return page(tracks, limit, offset, 120)
+
+        def tracks(self, ids):
+            self.track_batches.append(ids)
+            return {'tracks': [{'id': track_id, 'external_ids': {'isrc': f'isrc-{track_id}'}} for track_id in ids]}
+
+    spotify = Spotify.__new__(Spotify)
+    spotify.page_workers = 4
+    spotify.keep_data = False
+    spotify.cache = MetadataCache(tmp_path / 'cache.db')
+    spotify.sp = FakeSpotipy()
+
+    albums = list(spotify._iter_artist_album_tracks('artist'))
+    assert [len(batch) for batch in spotify.sp.batches] == [20, 20, 5]
+    assert sorted(len(batch) for batch in spotify.sp.track_batches) == [10, 15, 27, 50, 50, 50, 50]
+    assert len(albums) == 45
+    assert [track.id for track in albums[0]] == [f'a0-{i}' for i in range(120)]
+    assert albums[0][0].album_name == 'a0' and albums[0][119].isrc == 'ISRCA0119'
+
+    cached_albums = list(spotify._iter_artist_album_tracks('artist'))
+    assert len(spotify.sp.batches) == 3
+    assert [[track.id for track in album] for album in cached_albums] == \
+           [[track.id for track in album] for album in albums]
+
+
+def test_metadata_cache(tmp_path):
+    """Test metadata cache expiry, versions and size eviction."""
+    from savify.cache import MetadataCache
+
+    cache = MetadataCache(tmp_path / 'cache.db')
+    cache.put('album:1', {'name': 'album'})
+    cache.put('playlist:1', {'items': [1, 2]}, version='snapshot')
+    assert cache.get('album:1') == {'name': 'album'}
+    assert cache.get('playlist:1', version='snapshot') == {'items': [1, 2]}
+    assert cache.get('playlist:1', version='changed') is None
+
+    cache.ttl = -1
+    assert cache.get('album:1') is None
+
+    cache.ttl = 60
+    cache.max_size = 1
+    cache.put('a', 'a' * 1000)
+    assert cache.get('a') == 'a' * 1000
+    cache._evict()
+    assert cache.get('a') is None
+    cache.close()
+
+
+def test_sync_state(tmp_path):
+    """Test playlist sync state is stored per format, quality and group."""
+    from savify.index import SyncState
+
+    state = SyncState(tmp_path / 'index.db')
+    assert state.get('playlist', 'mp3', '0', None) == (None, [])
+
+    state.put('playlist', 'mp3', '0', None, 'snapshot', [['id', '/song.mp3', 'Artist - Song']])
+    assert state.get('playlist', 'mp3', '0', None) == ('snapshot', [['id', '/song.mp3', 'Artist - Song']])
+    assert state.get('playlist', 'flac', '0', None) == (None, [])
+    state.close()
+
+
+def test_sync(tmp_path):
+    """Test syncing only downloads added songs, appends to the M3U and prunes songs no playlist uses."""
+    from savify.track import Track
+    from savify.utils import PathHolder
+
+    def track(i):
+        return Track({'id': f'id{i}', 'name': f'song{i}', 'artists': [{'name': 'art'}]})
+
+    playlists = {'A' * 22: ['s1', [track(0), track(1)]], 'B' * 22: ['s1', [track(1), track(2)]]}
+
+    class FakeSpotify:
+        def get_playlist_snapshot(self, playlist_id, search=False):
+            return {'id': playlist_id, 'snapshot_id': playlists[playlist_id][0], 'name': playlist_id[0],
+                    'owner': {'display_name': 'me'}}
+
+        def playlist_tracks(self, playlist_id):
+            return playlists[playlist_id][1]
+
+    def iter_jobs(feed, jobs):
+        for job in feed:
+            job['location'].write_bytes(b'song')
+            job['returncode'] = 0
+            yield job
+
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)), use_journal=False)
+    s._spotify = FakeSpotify()
+    s._iter_jobs = iter_jobs
+    link = 'https://open.spotify.com/playlist/{}'.format
+    downloads = s.path_holder.get_download_dir()
+
+    assert len(s.sync(link('A' * 22))) == 2
+    assert len(s.sync(link('B' * 22))) == 2 and (downloads / 'art - song2.mp3').exists()
+    assert s.sync(link('A' * 22)) == []
+
+    playlists['A' * 22] = ['s2', [track(0), track(1), track(3)]]
+    assert [job['track'].id for job in s.sync(link('A' * 22))] == ['id3']
+    m3u = (downloads / 'A - me.m3u').read_text()
+    assert m3u.count('#EXTM3U') == 1 and m3u.count('#EXTINF') == 3
+
+    playlists['A' * 22] = ['s3', [track(3)]]
+    assert s.sync(link('A' * 22), prune=True) == []
+    assert not (downloads / 'art - song0.mp3').exists()
+    assert (downloads / 'art - song1.mp3').exists()
+    assert (downloads / 'A - me.m3u').read_text().count('#EXTINF') == 1
+
+
+def test_rate_limiter():
+    """Test token buckets, pausing and backoff delays."""
+    import time
+    from savify.ratelimit import RateLimiter, backoff, retry_after
+    from savify.types import Upstream
+
+    limiter = RateLimiter({Upstream.SEARCH: 20})
+    start = time.monotonic()
+    for _ in range(22):
+        limiter.acquire(Upstream.SEARCH)
+    assert time.monotonic() - start >= 0.09
+
+    limiter.pause(Upstream.MEDIA, 0.1)
+    start = time.monotonic()
+    limiter.acquire(Upstream.MEDIA)
+    assert time.monotonic() - start >= 0.09
+
+    assert retry_after({'Retry-After': '7'}) == 7
+    assert retry_after({}) is None
+    assert backoff(3, retry_after_seconds=7) == 7
+    assert 0 <= backoff(3) <= 8
+
+
+def test_shared_session(tmp_path, monkeypatch):
+    """Test the shared session pools connections, closes retried responses and is used for downloads."""
+    from savify.session import create_session
+    from savify.utils import PathHolder
+
+    session = create_session(pool_size=4, timeout=10)
+    assert session.get_adapter('https://i.scdn.co/image/1')._pool_maxsize == 4
+    assert session.timeout == 10
+
+    class Response:
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *_):
+            pass
+
+        def raise_for_status(self):
+            pass
+
+        def iter_content(self, _size):
+            yield b'image'
+
+    session.get = lambda url, stream: Response()
+    cover_art = PathHolder(str(tmp_path)).download_file('https://i.scdn.co/image/1', extension='jpg',
+                                                        session=session)
+    assert cover_art.read_bytes() == b'image'
+
+    from requests import Session
+    from savify.ratelimit import RateLimiter
+
+    class Retried:
+        status_code = 503
+        headers = {'Retry-After': '0'}
+        closed = False
+
+        def close(self):
+            self.closed = True
+
+    first, last = Retried(), Retried()
+    responses = [first, last]
+    monkeypatch.setattr(Session, 'request', lambda self, method, url, *args, **kwargs: responses.pop(0))
+    assert create_session(RateLimiter(), retries=1).get('https://i.scdn.co/image/2') is last
+    assert first.closed and not last.closed
+    monkeypatch.undo()
+
+    s = savify.Savify(api_credentials=('id', 'secret'), path_holder=PathHolder(str(tmp_path)), http_timeout=7)
+    assert s.spotify.sp.requests_timeout == 7
+
+
+def test_cover_art_cache(tmp_path):
+    """Test cover art is downloaded once per URL, even by concurrent requests."""
+    import time
+    from multiprocessing.dummy import Pool as ThreadPool
+    from savify.cache import CoverArtCache
+
+    downloads = list()
+
+    def download(url):
+        downloads.append(url)
+        time.sleep(0.05)
+        image = tmp_path / f'{len(downloads)}.jpg'
+        image.write_bytes(b'image')
+        return image
+
+    cache = CoverArtCache(tmp_path / 'cache.db', tmp_path / 'cover_art')
+    with ThreadPool(4) as pool:
+        paths = pool.map(lambda _: cache.get('https://i.scdn.co/image/1', download), range(8))
+
+    assert downloads == ['https://i.scdn.co/image/1']
+    assert len(set(paths)) == 1 and paths[0].read_bytes() == b'image'
+
+    cache.max_size = 0
+    cache.get('https://i.scdn.co/image/2', download)
+    cache._evict()
+    assert not paths[0].exists()
+    cache.close()
+
+
+def test_cache_limits(tmp_path):
+    """Test cache TTLs and sizes are passed through from Savify, with defaults for the ones left out."""
+    from savify.cache import RESOLUTION_MAX_ENTRIES, METADATA_MAX_SIZE
+    from savify.utils import PathHolder
+
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)), resolution_cache_ttl=60, metadata_cache_ttl=120,
+                      cover_art_cache_size=1024)
+    assert (s.resolution_cache.ttl, s.resolution_cache.max_entries) == (60, RESOLUTION_MAX_ENTRIES)
+    assert (s.metadata_cache.ttl, s.metadata_cache.max_size) == (120, METADATA_MAX_SIZE)
+    assert s.cover_art_cache.max_size == 1024
+
+    assert cli.days(2) == 2 * 24 * 60 * 60 and cli.megabytes(None) is None
+
+
+def test_startup_time(tmp_path, record_property):
+    """Benchmark startup, which should do no network or FFmpeg checks."""
+    import subprocess
+    import sys
+    import time
+    from pathlib import Path
+    from savify.utils import PathHolder
+
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-m', 'savify', '--version'], cwd=Path(__file__).parents[1],
+                            capture_output=True)
+    version_time = time.perf_counter() - start
+    assert result.returncode == 0
+
+    start = time.perf_counter()
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)))
+    construct_time = time.perf_counter() - start
+    assert s._spotify is None and not s._ready
+
+    record_property('version_seconds', round(version_time, 3))
+    record_property('construct_seconds', round(construct_time, 3))
+
+
+def test_import_time(record_property):
+    """Benchmark importing the package and CLI, which should leave the heavy dependencies unloaded."""
+    import re
+    import subprocess
+    import sys
+    from pathlib import Path
+
+    heavy = ['youtube_dl', 'spotipy', 'requests', 'ffmpy', 'asyncio']
+    code = f'import sys, savify, savify.cli; print(sorted(set({heavy!r}) & set(sys.modules)))'
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=Path(__file__).parents[1],
+                            capture_output=True, text=True)
+    assert result.returncode == 0
+    assert result.stdout.strip() == '[]'
+
+    cumulative = re.search(r'\|\s*(\d+) \| savify\.cli$', result.stderr, re.MULTILINE)
+    record_property('import_microseconds', int(cumulative.group(1)))
+
+
+def test_parse_link():
+    """Test Spotify URIs and links are classified offline."""
+    from savify.link import is_link, parse_link
+
+    assert parse_link('spotify:track:4uLU6hMCjMI75M1A2tKUQC') == ('track', '4uLU6hMCjMI75M1A2tKUQC')
+    assert parse_link('spotify:user:track:playlist:37i9dQZF1DXcBWIGoYBM5M') == ('playlist', '37i9dQZF1DXcBWIGoYBM5M')
+    assert parse_link('https://open.spotify.com/album/1DFixLWuPkv3KT3TnV35m3?si=track') == \
+        ('album', '1DFixLWuPkv3KT3TnV35m3')
+    assert parse_link('https://open.spotify.com/intl-de/artist/0OdUWJ0sBjDrqHygGUXeCF') == \
+        ('artist', '0OdUWJ0sBjDrqHygGUXeCF')
+    assert parse_link('https://open.spotify.com/playlist/track') is None
+    assert parse_link('https://www.youtube.com/watch?v=dQw4w9WgXcQ') is None
+    assert parse_link('tracks by someone') is None
+
+    assert is_link('https://www.youtube.com/watch?v=dQw4w9WgXcQ')
+    assert not is_link('tracks by someone')
+
+
+def test_download_many_queue(tmp_path):
+    """Test batch queries share one job per track and skip unsupported queries."""
+    from savify.exceptions import UrlNotSupportedError
+    from savify.track import Track
+    from savify.types import Type
+    from savify.utils import PathHolder
+
+    tracks = [Track({'id': f'id{i}', 'name': f'song{i}', 'artists': [{'name': 'art'}]}) for i in range(3)]
+    pages = {'a': [tracks[:2]], 'b': [[tracks[1]], [tracks[2], tracks[2]]]}
+
+    def iter_query(query, query_type=None, artist_albums=False):
+        if query not in pages:
+            raise UrlNotSupportedError(query)
+        yield from pages[query]
+
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)))
+    s._iter_query = iter_query
+    jobs, results = list(), list()
+    fed = list(s._iter_query_jobs(['a', 'https://example.com', 'b'], Type.TRACK, False, jobs, results,
+                                  skip_unsupported=True))
+
+    assert [job['track'].id for job in fed] == ['id0', 'id1', 'id2']
+    assert [[job['track'].id for job in query_jobs] for query_jobs in results] == \
+        [['id0', 'id1'], [], ['id1', 'id2', 'id2']]
+    assert results[0][1] is results[2][0]
+
+
+def test_link_reuse(tmp_path):
+    """Test a song grouped into two playlists is downloaded once and linked into the second."""
+    from savify.track import Track
+    from savify.types import Type, LinkMode
+    from savify.utils import PathHolder
+
+    first = Track({'id': 'id0', 'name': 'song', 'artists': [{'name': 'art'}], 'playlist': 'A'})
+    second = Track({'id': 'id0', 'name': 'song', 'artists': [{'name': 'art'}], 'playlist': 'B'})
+    pages = {'a': [[first]], 'b': [[second]]}
+
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)), group='%playlist%', link_mode=LinkMode.HARDLINK)
+    s._iter_query = lambda query, query_type=None, artist_albums=False: iter(pages[query])
+    jobs, results = list(), list()
+    fed = list(s._iter_query_jobs(['a', 'b'], Type.TRACK, False, jobs, results))
+    assert len(fed) == 1 and results[1][0]['original'] is fed[0]
+
+    fed[0]['location'].parent.mkdir(parents=True)
+    fed[0]['location'].write_bytes(b'song')
+    fed[0]['returncode'] = 0
+    link = s._finish_link(results[1][0])
+
+    assert link['returncode'] == 0 and link['location'].parent.name == 'B'
+    assert link['location'].stat().st_ino == fed[0]['location'].stat().st_ino
+
+
+def test_job_journal(tmp_path):
+    """Test the journal keeps each track's progress and the temp media of unfinished tracks until they expire."""
+    from savify.index import JobJournal
+    from savify.types import JobState
+    from savify.utils import clean
+
+    journal = JobJournal(tmp_path / 'index.db')
+    journal.queue(['a', 'b'], 'mp3', '0')
+    journal.update('a', 'mp3', '0', JobState.DOWNLOADED, video_id='video', source='/temp/a.webm', acodec='opus')
+    journal.update('a', 'mp3', '0', JobState.FAILED, error='Failed to convert song.')
+    journal.queue(['a'], 'mp3', '0')
+    journal.update('b', 'mp3', '0', JobState.DONE)
+
+    assert journal.get('a', 'mp3', '0') == {'state': 'failed', 'video_id': 'video', 'source': '/temp/a.webm',
+                                            'acodec': 'opus', 'error': 'Failed to convert song.'}
+    assert journal.get('a', 'flac', '0') is None
+    assert journal.unfinished() == {'a'}
+
+    temp = tmp_path / 'temp'
+    temp.mkdir()
+    for name in ('a.webm.part', 'b.webm', 'cover.jpg'):
+        (temp / name).write_bytes(b'')
+
+    clean(temp, keep=journal.unfinished())
+    assert [path.name for path in temp.iterdir()] == ['a.webm.part']
+
+    journal.expire()
+    assert journal.get('b', 'mp3', '0') is None and journal.unfinished() == {'a'}
+    journal.expire(failed_ttl=-1)
+    clean(temp, keep=journal.unfinished())
+    assert journal.unfinished() == set() and list(temp.iterdir()) == []
+    journal.close()
+
+
+def test_shared_database(tmp_path):
+    """Test the index and journal can be written from many threads at once through their own connections."""
+    from multiprocessing.dummy import Pool as ThreadPool
+    from savify.index import DownloadIndex, JobJournal
+    from savify.types import JobState
+
+    index, journal = DownloadIndex(tmp_path / 'index.db'), JobJournal(tmp_path / 'index.db')
+
+    def write(i):
+        journal.queue([str(i)], 'mp3', '0')
+        index.add(str(i), 'mp3', '0', tmp_path / f'{i}.mp3')
+        journal.update(str(i), 'mp3', '0', JobState.DONE)
+
+    with ThreadPool(16) as pool:
+        pool.map(write, range(200))
+
+    assert len(index.lookup([str(i) for i in range(200)], 'mp3', '0')) == 200
+    assert index._connection.execute('PRAGMA journal_mode').fetchone() == ('wal',)
+    index.close()
+    journal.close()
+
+
+def test_stage_error(tmp_path):
+    """Test a job whose stage raises is finished like any other failure."""
+    from savify.track import Track
+    from savify.utils import PathHolder
+
+    def broken(job):
+        raise OSError('cover art')
+
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)))
+    s._transcode = broken
+    track = Track({'id': 'id0', 'name': 'song', 'artists': [{'name': 'art'}]})
+    job = s._build_pipeline().stages[-1]({'track': track, 'returncode': -1, 'location': None, 'source': 'a'})
+
+    assert job['returncode'] == 1 and job['error'] == 'Transcode failed. [cover art]' and 'source' not in job
+    assert s.completed == 1 and s.journal.get('id0', s.download_format, s.quality)['state'] == 'failed'
+
+
+def test_candidate_scoring(record_property):
+    """Benchmark scoring recorded search results, which should pick the studio version of each track."""
+    import json
+    import time
+    from pathlib import Path
+    from savify.resolver import best_candidate
+    from savify.track import Track
+
+    with open(Path(__file__).parent / 'fixtures' / 'search_results.json', encoding='utf8') as file:
+        fixtures = json.load(file)
+
+    for fixture in fixtures:
+        track = Track(fixture['track'])
+        assert best_candidate(track, fixture['candidates'])['id'] == fixture['expected']
+
+    assert best_candidate(Track(fixtures[0]['track']), []) is None
+
+    tracks = [(Track(fixture['track']), fixture['candidates']) for fixture in fixtures]
+    rounds = 1000
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for track, candidates in tracks:
+            best_candidate(track, candidates)
+    elapsed = time.perf_counter() - start
+
+    record_property('microseconds_per_search', round(elapsed / (rounds * len(tracks)) * 1e6, 1))
+
+
+def test_isrc_dedup(tmp_path):
+    """Test the same recording on a single and an album is downloaded once and found by its ISRC later."""
+    from savify.track import Track
+    from savify.types import Type
+    from savify.utils import PathHolder
+
+    single = Track({'id': 'id0', 'name': 'song', 'artists': [{'name': 'art'}], 'album': {'name': 'single'},
+                    'external_ids': {'isrc': 'usrc17607839'}})
+    album = Track({'id': 'id1', 'name': 'song', 'artists': [{'name': 'art'}], 'album': {'name': 'album'},
+                   'external_ids': {'isrc': 'US-RC1-76-07839'}})
+    other = Track({'id': 'id2', 'name': 'other', 'artists': [{'name': 'art'}], 'album': {'name': 'album'}})
+    assert single.recording_id == album.recording_id == 'USRC17607839' and other.recording_id == 'id2'
+
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)), group='%album%')
+    s._iter_query = lambda query, query_type=None, artist_albums=False: iter([[single, album, other]])
+    jobs, results = list(), list()
+    fed = list(s._iter_query_jobs(['artist'], Type.ARTIST, True, jobs, results))
+    assert [job['track'].id for job in fed] == ['id0', 'id2']
+    assert results[0][1]['original'] is fed[0]
+
+    fed[0]['location'].parent.mkdir(parents=True)
+    fed[0]['location'].write_bytes(b'song')
+    s._record_download(single, fed[0]['location'])
+    status, = s._check_index([album])
+    assert status['returncode'] == 0 and status['location'].read_bytes() == b'song'
+
+
+def test_iter_download_links(tmp_path):
+    """Test iter_download yields the links to a recording saved under another album once it is downloaded."""
+    from savify.track import Track
+    from savify.types import Type
+    from savify.utils import PathHolder
+
+    single = Track({'id': 'id0', 'name': 'song', 'artists': [{'name': 'art'}], 'album': {'name': 'single'},
+                    'external_ids': {'isrc': 'USRC17607839'}})
+    album = Track({'id': 'id1', 'name': 'song', 'artists': [{'name': 'art'}], 'album': {'name': 'album'},
+                   'external_ids': {'isrc': 'USRC17607839'}})
+
+    def iter_jobs(feed, jobs):
+        for job in feed:
+            job['location'].parent.mkdir(parents=True, exist_ok=True)
+            job['location'].write_bytes(b'song')
+            job['returncode'] = 0
+            yield job
+
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)), group='%album%', use_journal=False)
+    s._iter_query = lambda query, query_type=None, artist_albums=False: iter([[single], [album]])
+    s._iter_jobs = iter_jobs
+    statuses = list(s.iter_download('artist', Type.ARTIST, artist_albums=True))
+
+    assert [(status['track'].id, status['returncode']) for status in statuses] == [('id0', 0), ('id1', 0)]
+    assert statuses[1]['location'].parent.name == 'album' and statuses[1]['location'].read_bytes() == b'song'
+
+
+def test_track_memory(record_property):
+    """Benchmark the memory tracks of a large album retain, which shouldn't include the raw album data."""
+    import gc
+    import pickle
+    import tracemalloc
+    from savify.spotify import _pack_album
+
+    def album():
+        tracks = [{'id': f'{i:022d}', 'name': f'song {i}', 'artists': [{'name': 'art', 'id': 'artist'}],
+                   'track_number': i, 'disc_number': 1, 'duration_ms': 200000, 'uri': f'spotify:track:{i}',
+                   'external_urls': {'spotify': f'https://open.spotify.com/track/{i}'},
+                   'external_ids': {'isrc': f'USRC1{i:07d}'}, 'preview_url': f'https://p.scdn.co/mp3-preview/{i}',
+                   'available_markets': [f'{a}{b}' for a in 'ABCDEFGHIJKLM' for b in 'ABCDEFGHIJKLMN']}
+                  for i in range(5000)]
+        return {'id': 'album', 'name': 'album', 'total_tracks': len(tracks), 'release_date': '2020',
+                'images': [{'url': 'https://i.scdn.co/image/cover'}], 'tracks': {'items': tracks}}
+
+    def retained(**kwargs):
+        gc.collect()
+        tracemalloc.start()
+        tracks = _pack_album(album(), **kwargs)
+        gc.collect()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        return tracks, size
+
+    tracks, compact = retained()
+    _, raw = retained(keep_data=True)
+    assert compact * 10 < raw
+
+    track = tracks[0]
+    assert track.data is None and not hasattr(track, '__dict__')
+    with pytest.raises(AttributeError):
+        track.name = 'other'
+
+    copy = pickle.loads(pickle.dumps(track))
+    assert (copy.id, copy.artists, copy.isrc) == (track.id, track.artists, track.isrc)
+
+    record_property('compact_bytes_per_track', compact // len(tracks))
+    record_property('raw_bytes_per_track', raw // len(tracks))
+
+
+def test_track_from_items(record_property):
+    """Benchmark parsing a page of album tracks in bulk against constructing each track on its own."""
+    import timeit
+    from savify.track import Track
+    from savify.types import Type
+
+    album = {'id': 'album', 'name': 'album', 'total_tracks': 1000, 'release_date': '2020',
+             'images': [{'url': 'https://i.scdn.co/image/cover'}]}
+    items = [{'id': f'{i:022d}', 'name': f'song {i}', 'artists': [{'name': 'art'}], 'track_number': i,
+              'disc_number': 1, 'duration_ms': 200000, 'uri': f'spotify:track:{i}',
+              'external_urls': {'spotify': f'https://open.spotify.com/track/{i}'},
+              'external_ids': {'isrc': f'USRC1{i:07d}'}} for i in range(1000)]
+    items_with_album = [{**item, 'album': album} for item in items]
+
+    bulk = Track.from_items(items, {'album': album})
+    single = [Track(item) for item in items_with_album]
+    assert [[getattr(track, name) for name in Track.__slots__] for track in bulk] == \
+        [[getattr(track, name) for name in Track.__slots__] for track in single]
+
+    episode, = Track.from_items([{'id': 'episode', 'images': [{'url': 'image'}]}], {'show': {'publisher': 'host'}},
+                                track_type=Type.EPISODE)
+    assert (episode.name, episode.artists, episode.album_name, episode.cover_art_url) == \
+        ('Unknown Episode', ('host',), 'Unknown Show', 'image')
+
+    single_time = min(timeit.repeat(lambda: [Track(item) for item in items_with_album], number=5, repeat=5))
+    bulk_time = min(timeit.repeat(lambda: Track.from_items(items, {'album': album}), number=5, repeat=5))
+    record_property('constructor_microseconds_per_track', round(single_time / 5000 * 1e6, 2))
+    record_property('from_items_microseconds_per_track', round(bulk_time / 5000 * 1e6, 2))
+
+
+def test_safe_path_string(monkeypatch, record_property):
+    """Benchmark path sanitisation over real track names and test the filesystem mode's limits."""
+    import re
+    import timeit
+    from pathlib import Path
+    from savify import utils
+    from savify.utils import safe_path_string, MAX_COMPONENT_BYTES, RESERVED_SUFFIX_BYTES
+
+    def concatenating(string):
+        new_string = ''
+        for c in string:
+            new_string = new_string + (c if c.isalnum() or c in utils.SAFE_PUNCTUATION else '_')
+        return re.sub(r'\.+$', '', new_string.rstrip())
+
+    names = (Path(__file__).parent / 'fixtures' / 'track_names.txt').read_text(encoding='utf8').splitlines()
+    corpus = [f'{name}.mp3' for name in names] + [name.split(' - ')[0] for name in names]
+    assert [safe_path_string(name) for name in corpus] == [concatenating(name) for name in corpus]
+
+    long = safe_path_string('é' * 200 + ' - song.flac', filesystem=True)
+    assert len(long.encode('utf8')) <= MAX_COMPONENT_BYTES - RESERVED_SUFFIX_BYTES and long.endswith('é.flac')
+
+    monkeypatch.setattr(utils, 'RESERVED_NAMES', utils.WINDOWS_RESERVED_NAMES)
+    safe_path_string.cache_clear()
+    assert [safe_path_string(name, filesystem=True) for name in ('CON.mp3', 'nul', 'Console')] == \
+        ['CON_.mp3', 'nul_', 'Console']
+    safe_path_string.cache_clear()
+
+    rounds = 20
+    concatenating_time = timeit.timeit(lambda: [concatenating(name) for name in corpus], number=rounds)
+    translate_time = timeit.timeit(lambda: [safe_path_string.__wrapped__(name) for name in corpus], number=rounds)
+    cached_time = timeit.timeit(lambda: [safe_path_string(name) for name in corpus], number=rounds)
+    calls = rounds * len(corpus)
+    record_property('concatenating_microseconds', round(concatenating_time / calls * 1e6, 2))
+    record_property('translate_microseconds', round(translate_time / calls * 1e6, 2))
+    record_property('cached_microseconds', round(cached_time / calls * 1e6, 2))
+
+
+def test_write_m3u(tmp_path):
+    """Test M3U files are named after the album when there is no playlist, as a valid file name."""
+    from savify.track import Track
+    from savify.types import Type
+    from savify.utils import PathHolder
+
+    s = savify.Savify(path_holder=PathHolder(str(tmp_path)))
+    track = Track({'id': 'id0', 'name': 'song', 'artists': [{'name': 'art'}], 'album': {'name': 'AC/DC ' * 60}})
+    s._write_m3u([{'track': track, 'returncode': 0, 'location': s._output_path(track)}], Type.ALBUM)
+
+    m3u, = s.path_holder.get_download_dir().glob('*.m3u')
+    assert m3u.name.startswith('AC_DC AC_DC') and len(m3u.name.encode('utf8')) <= 255